@@ -6,17 +6,19 @@ import time
 import http
 import json
 import random
-import requests
 import argparse
+import multiprocessing
 import traceback
 import settings
+import cfg_export
 
-from web3 import Web3
 from utils import *
 from rosetta import *
 from dynamic_call_tree import *
 from control_flow_graph import *
 from dynamic_taint_analysis import *
+from trace_prefetcher import *
+from trace_store import *
 
 def analyze_trace(model, trace, step, transaction, taint_runner, call_tree, control_flow_graph, dependencies):
     execution_begin = time.time()
@@ -27,45 +29,58 @@ def analyze_trace(model, trace, step, transaction, taint_runner, call_tree, cont
         result["block"] = transaction["blockNumber"]
         result["patterns"] = []
 
+    context = Context(trace, taint_runner, call_tree, control_flow_graph, dependencies)
+
+    if settings.SAVE_CFG:
+        control_flow_graph.writer = cfg_export.open_cfg_writer(transaction["hash"], settings.SAVE_CFG)
+
     first_step = step
-    while step in trace:
-        if settings.DEBUG_MODE:
-            if step == first_step:
-                print("")
-                print("Analyzing transaction: "+transaction["hash"]+" (block: "+str(transaction["blockNumber"])+")")
-                print(transaction["from"].lower()+" --> "+transaction["to"].lower())
-                print("")
-                print("Step \t PC \t Operation\t Gas       \t GasCost \t Depth")
-                print("---------------------------------------------------------------------------")
-            print(str(step)+" \t "+str(trace[step]["pc"])+" \t "+trace[step]["op"].ljust(10)+"\t "+str(trace[step]["gas"]).ljust(10)+" \t "+str(trace[step]["gasCost"]).ljust(10)+" \t "+str(trace[step]["depth"])+" \t "+str(control_flow_graph.current_contract_address)+(" \t "+"[Error]" if "error" in trace[step] else ""))
-
-        control_flow_graph.execute(trace, step, transaction)
-        taint_runner.propagate_taint(trace[step], control_flow_graph.current_contract_address)
-        call_tree.execute(trace, step)
-
-
-        if "patterns" in dir(model):
-            for pattern in model.patterns:
-                try:
-                    if evaluate_pattern(pattern.condition, trace, step, taint_runner, call_tree, control_flow_graph, dependencies):
-                        condition = pattern_to_str(pattern.condition, trace, step, control_flow_graph, dependencies)
-                        print("=================================== Warning =======================================")
-                        print("Transaction: \t "+transaction["hash"])
-                        print("Contract: \t "+control_flow_graph.current_contract_address)
-                        print("Description: \t "+pattern.description)
-                        if settings.DEBUG_MODE:
-                            print("Condition: "+condition)
-                        print("===================================================================================")
-                        if settings.RESULTS_FOLDER:
-                            detected_pattern = {}
-                            detected_pattern["description"] = pattern.description
-                            detected_pattern["condition"] = condition
-                            detected_pattern["contract"] = control_flow_graph.current_contract_address
-                            result["patterns"].append(detected_pattern)
-                except Exception as e:
-                    if not "error" in trace[step]:
-                            raise e
-        step += 1
+    try:
+        while step in trace:
+            if settings.DEBUG_MODE:
+                if step == first_step:
+                    print("")
+                    print("Analyzing transaction: "+transaction["hash"]+" (block: "+str(transaction["blockNumber"])+")")
+                    print(transaction["from"].lower()+" --> "+transaction["to"].lower())
+                    print("")
+                    print("Step \t PC \t Operation\t Gas       \t GasCost \t Depth")
+                    print("---------------------------------------------------------------------------")
+                print(str(step)+" \t "+str(trace[step]["pc"])+" \t "+trace[step]["op"].ljust(10)+"\t "+str(trace[step]["gas"]).ljust(10)+" \t "+str(trace[step]["gasCost"]).ljust(10)+" \t "+str(trace[step]["depth"])+" \t "+str(control_flow_graph.current_contract_address)+(" \t "+"[Error]" if "error" in trace[step] else ""))
+
+            control_flow_graph.execute(trace, step, transaction)
+            if taint_runner:
+                taint_runner.propagate_taint(trace[step], control_flow_graph.current_contract_address)
+            call_tree.execute(trace, step)
+
+
+            if "patterns" in dir(model):
+                context.memo.clear()
+                for pattern in model.pattern_index.get(trace[step]["op"], model.unanchored_patterns):
+                    try:
+                        if pattern.predicate(context, step, None):
+                            condition = pattern_to_str(pattern.condition, trace, step, control_flow_graph, dependencies)
+                            print("=================================== Warning =======================================")
+                            print("Transaction: \t "+transaction["hash"])
+                            print("Contract: \t "+control_flow_graph.current_contract_address)
+                            print("Description: \t "+pattern.description)
+                            if settings.DEBUG_MODE:
+                                print("Condition: "+condition)
+                            print("===================================================================================")
+                            if settings.RESULTS_FOLDER:
+                                detected_pattern = {}
+                                detected_pattern["description"] = pattern.description
+                                detected_pattern["condition"] = condition
+                                detected_pattern["contract"] = control_flow_graph.current_contract_address
+                                result["patterns"].append(detected_pattern)
+                    except Exception as e:
+                        if not "error" in trace[step]:
+                                raise e
+            step += 1
+    finally:
+        # Analyses that fail still leave a complete file of the part of the graph they went through
+        if control_flow_graph.writer is not None:
+            control_flow_graph.writer.close()
+            control_flow_graph.writer = None
 
     execution_end = time.time()
     execution_delta = execution_end - execution_begin
@@ -80,7 +95,8 @@ def analyze_trace(model, trace, step, transaction, taint_runner, call_tree, cont
         result["execution_time"] = execution_delta
 
     if settings.SAVE_CFG:
-        control_flow_graph.save_control_flow_graph(transaction["hash"], settings.SAVE_CFG)
+        if not settings.SAVE_CFG in cfg_export.CFG_FORMATS:
+            cfg_export.render_control_flow_graph(transaction["hash"], settings.SAVE_CFG)
 
     if settings.RESULTS_FOLDER:
         return (step, dependencies, result)
@@ -97,96 +113,200 @@ def analyze_transactions(connection, transactions):
     if not model:
         return results
 
+    taint_required = requires_taint(model)
+
     if args.save:
         execution_trace["transactions"] = transactions
 
-    bins = []
-    for transaction in transactions:
-        found = False
-        for i in range(len(bins)):
-            for j in range(len(bins[i])):
-                if bins[i][j]["blockNumber"] == transaction["blockNumber"] and bins[i][j]["from"] != transaction["from"]:
-                    bins[i].append(transaction)
-                    found = True
-                    break
-                if bins[i][j]["from"] == transaction["from"] and bins[i][j]["input"] != transaction["input"]:
-                    bins[i].append(transaction)
-                    found = True
-                    break
-            if found:
-                break
-        if not found:
-            bins.append([transaction])
+    bins = bin_transactions(transactions)
+
+    # Saved traces are meant to be analyzed again with any patterns, hence every trace is retrieved
+    candidates = screen_bins(connection, model, bins) if settings.SCREEN_TRANSACTIONS and not args.load and not args.save else None
 
     transaction_counter = 0
 
-    for i in range(len(bins)):
-        step = 0
-        trace = {}
-        dependencies = {}
-
-        taint_runner = TaintRunner()
-        call_tree = DynamicCallTree()
-        control_flow_graph = ControlFlowGraph()
-
-        for j in range(len(bins[i])):
-            transaction = bins[i][j]
-            transaction_counter += 1
-
-            dependency_steps = set()
-            for pattern in list(dependencies):
-                if not pattern.__class__.__name__ == "DataDependency" and dependencies[pattern]["dependencies"]:
-                    dependencies[pattern]["sources"] = []
-                    dependencies[pattern]["destinations"] = []
-                    for k in range(len(dependencies[pattern]["dependencies"])):
-                        if not dependencies[pattern]["dependencies"][k]["source"] in dependencies[pattern]["sources"]:
-                            dependencies[pattern]["sources"].append(dependencies[pattern]["dependencies"][k]["source"])
-                        if not dependencies[pattern]["dependencies"][k]["destination"] in dependencies[pattern]["destinations"]:
-                            dependencies[pattern]["destinations"].append(dependencies[pattern]["dependencies"][k]["destination"])
-                elif not pattern.__class__.__name__ == "DataDependency":
-                    del dependencies[pattern]
-                if pattern in dependencies:
-                    dependency_steps = dependency_steps.union(set(dependencies[pattern]["sources"]))
-                    dependency_steps = dependency_steps.union(set(dependencies[pattern]["destinations"]))
-            for t in list(trace):
-                if not t in dependency_steps:
-                    del trace[t]
-
-            if args.load:
-                for k in range(len(execution_trace["traces"][transaction["hash"]]["structLogs"])):
-                    trace[k+step] = execution_trace["traces"][transaction["hash"]]["structLogs"][k]
-                    trace[k+step]["transaction"] = transaction
-            else:
-                retrieval_begin = time.time()
-                trace_response = request_debug_trace(connection, transaction["hash"])
-                if "error" in trace_response:
-                    print("An error occured in retrieving the trace: "+str(trace_response["error"]))
-                    raise Exception("An error occured in retrieving the trace: {}".format(trace_response["error"]))
+    if settings.WORKERS > 1 and len(bins) > 1:
+        # Bins do not share any state, hence they are analyzed independently by worker processes
+        jobs = []
+        for i in range(len(bins)):
+            # Loaded traces are sent along with their bin, so that a worker only receives the ones it analyzes
+            traces = {transaction["hash"]: execution_trace["traces"][transaction["hash"]] for transaction in bins[i]} if args.load else None
+            jobs.append((bins[i], candidates & set(transaction["hash"] for transaction in bins[i]) if candidates is not None else None, transaction_counter, len(transactions), traces))
+            transaction_counter += len(bins[i])
+        with multiprocessing.Pool(min(settings.WORKERS, len(bins)), initializer=initialize_worker, initargs=(args, worker_settings())) as pool:
+            for bin_results, bin_traces, bin_renderings in pool.imap(analyze_bin_in_worker, jobs):
+                results += bin_results
+                if args.save:
+                    execution_trace["traces"].update(bin_traces)
+                for filename, extension in bin_renderings:
+                    cfg_export.render_control_flow_graph(filename, extension)
+        return results
+
+    # Traces are retrieved in the order in which the bins are analyzed
+    prefetcher = TracePrefetcher(connection, [bins[i][j] for i in range(len(bins)) for j in range(len(bins[i])) if candidates is None or bins[i][j]["hash"] in candidates], tracer=trace_tracer(model)) if not args.load else None
+
+    try:
+        for i in range(len(bins)):
+            results += analyze_bin(model, taint_required, bins[i], candidates, prefetcher, transaction_counter, len(transactions))
+            transaction_counter += len(bins[i])
+    finally:
+        if prefetcher:
+            prefetcher.close()
+
+    return results
+
+def screen_bins(connection, model, bins):
+    """ Returns the hashes of the transactions to be analyzed, retrieving the call structure of every transaction beforehand """
+    screening_begin = time.time()
+    candidates = set()
+    prefetcher = TracePrefetcher(connection, [bins[i][j] for i in range(len(bins)) for j in range(len(bins[i]))], tracer=CALL_STRUCTURE_TRACER)
+    try:
+        for transactions in bins:
+            summaries = []
+            for transaction in transactions:
+                response = prefetcher.get(transaction)
+                if "result" in response:
+                    # The analysis attributes the first call frame of every transaction of a bin to the first transaction
+                    summaries.append(summarize_call_structure(response["result"], transactions[0]["to"]))
                 else:
-                    if args.save:
-                        if not "traces" in execution_trace:
-                            execution_trace["traces"] = {}
-                        execution_trace["traces"][transaction["hash"]] = trace_response["result"]
-                    for k in range(len(trace_response["result"]["structLogs"])):
-                        trace[k+step] = trace_response["result"]["structLogs"][k]
-                        trace[k+step]["transaction"] = transaction
-                retrieval_end = time.time()
-                retrieval_delta = retrieval_end - retrieval_begin
-                print("Retrieving transaction "+transaction["hash"]+" took %.2f second(s). (%d MB) (%d/%d)" % (retrieval_delta, (deep_getsizeof(trace, set()) / 1024) / 1024, transaction_counter, len(transactions)))
-
-            for pattern in list(dependencies):
-                if dependencies[pattern]["dependencies"]:
-                    del dependencies[pattern]
-
-            step, dependencies, result = analyze_trace(model, trace, step, transaction, taint_runner, call_tree, control_flow_graph, dependencies)
+                    print("An error occured in screening transaction "+transaction["hash"]+", it is analyzed in full: "+str(response["error"]))
+                    summaries.append(None)
+            for transaction, candidate in zip(transactions, screen_transactions(model, summaries)):
+                if candidate:
+                    candidates.add(transaction["hash"])
+    finally:
+        prefetcher.close()
+    screening_end = time.time()
+    print("Screening "+str(sum(len(transactions) for transactions in bins))+" transaction(s) took %.2f second(s). (%d to be analyzed)" % (screening_end - screening_begin, len(candidates)))
+    return candidates
 
-            taint_runner.clear_taint()
+def analyze_bin(model, taint_required, transactions, candidates, prefetcher, transaction_counter, transactions_count):
+    results = []
+
+    step = 0
+    trace = TraceStore()
+    dependencies = {}
+
+    taint_runner = TaintRunner() if taint_required else None
+    call_tree = DynamicCallTree()
+    control_flow_graph = ControlFlowGraph()
 
+    for transaction in transactions:
+        transaction_counter += 1
+
+        if candidates is not None and not transaction["hash"] in candidates:
+            # Analyzing the transaction would only have attributed the first call frame of the bin, if it is the first
+            if not control_flow_graph.current_contract_address:
+                control_flow_graph.current_contract_address = transaction["to"]
+            print("Skipping transaction "+transaction["hash"]+" as its call structure rules out every pattern. (%d/%d)" % (transaction_counter, transactions_count))
             if settings.RESULTS_FOLDER:
-                results.append(result)
+                results.append({"transaction": transaction["hash"], "block": transaction["blockNumber"], "patterns": [], "screened": True})
+            continue
+
+        dependency_steps = set()
+        for pattern in list(dependencies):
+            if not pattern.__class__.__name__ == "DataDependency" and dependencies[pattern]["dependencies"]:
+                dependencies[pattern]["sources"] = []
+                dependencies[pattern]["destinations"] = []
+                for k in range(len(dependencies[pattern]["dependencies"])):
+                    if not dependencies[pattern]["dependencies"][k]["source"] in dependencies[pattern]["sources"]:
+                        dependencies[pattern]["sources"].append(dependencies[pattern]["dependencies"][k]["source"])
+                    if not dependencies[pattern]["dependencies"][k]["destination"] in dependencies[pattern]["destinations"]:
+                        dependencies[pattern]["destinations"].append(dependencies[pattern]["dependencies"][k]["destination"])
+            elif not pattern.__class__.__name__ == "DataDependency":
+                del dependencies[pattern]
+            if pattern in dependencies:
+                dependency_steps = dependency_steps.union(set(dependencies[pattern]["sources"]))
+                dependency_steps = dependency_steps.union(set(dependencies[pattern]["destinations"]))
+        trace.retain(dependency_steps)
+
+        if args.load:
+            trace.append(step, execution_trace["traces"][transaction["hash"]]["structLogs"], transaction)
+        else:
+            retrieval_begin = time.time()
+            trace_response = prefetcher.get(transaction)
+            if "error" in trace_response:
+                print("An error occured in retrieving the trace: "+str(trace_response["error"]))
+                raise Exception("An error occured in retrieving the trace: {}".format(trace_response["error"]))
+            else:
+                if args.save:
+                    if not "traces" in execution_trace:
+                        execution_trace["traces"] = {}
+                    # Saved traces are written once the analysis is done, so they are read entirely
+                    trace_response["result"]["structLogs"] = list(trace_response["result"]["structLogs"])
+                    execution_trace["traces"][transaction["hash"]] = trace_response["result"]
+                trace.append(step, trace_response["result"]["structLogs"], transaction)
+            retrieval_end = time.time()
+            retrieval_delta = retrieval_end - retrieval_begin
+
+        for pattern in list(dependencies):
+            if dependencies[pattern]["dependencies"]:
+                del dependencies[pattern]
+
+        step, dependencies, result = analyze_trace(model, trace, step, transaction, taint_runner, call_tree, control_flow_graph, dependencies)
+
+        if not args.load:
+            # Streamed structLogs are read along with the analysis, which only waits for them while they are read
+            if isinstance(trace_response["result"]["structLogs"], StructLogStream):
+                retrieval_delta += trace_response["result"]["structLogs"].elapsed
+            print("Retrieving transaction "+transaction["hash"]+" took %.2f second(s). (%d MB) (%d/%d)" % (retrieval_delta, (deep_getsizeof(trace, set()) / 1024) / 1024, transaction_counter, transactions_count))
+
+        if taint_runner:
+            taint_runner.clear_taint()
+
+        if settings.RESULTS_FOLDER:
+            results.append(result)
 
     return results
 
+def trace_tracer(model):
+    """ Returns the tracer traces are retrieved with, None retrieving full structLogs with the default tracer """
+    # Saved traces are meant to be analyzed again with any patterns, hence they are retrieved in full
+    if not settings.SHAPE_TRACES or args.save:
+        return None
+    return struct_log_tracer(memory_opcodes(model))
+
+def worker_settings():
+    """ Returns the settings a worker process needs to analyze bins like the main process """
+    return {name: getattr(settings, name) for name in dir(settings) if name.isupper() and name != "W3"}
+
+def initialize_worker(arguments, values):
+    global args, execution_trace, worker
+    args = arguments
+    for name in values:
+        setattr(settings, name, values[name])
+    if args.save:
+        execution_trace = {"transactions": [], "traces": {}}
+    # Graphviz runs in background in the main process, as the pool may stop workers before their renderings are done
+    cfg_export.deferred_renderings = []
+    worker = {}
+    worker["model"] = load_model(settings.PATTERNS_FILE)
+    worker["taint_required"] = requires_taint(worker["model"])
+    if not args.load:
+        import http.client
+        worker["connection"] = http.client.HTTPConnection(settings.RPC_HOST, settings.RPC_PORT)
+
+def analyze_bin_in_worker(job):
+    global execution_trace
+    transactions, candidates, transaction_counter, transactions_count, traces = job
+    if args.load:
+        execution_trace = {"traces": traces}
+    prefetcher = TracePrefetcher(worker["connection"], [transaction for transaction in transactions if candidates is None or transaction["hash"] in candidates], tracer=trace_tracer(worker["model"])) if not args.load else None
+    try:
+        results = analyze_bin(worker["model"], worker["taint_required"], transactions, candidates, prefetcher, transaction_counter, transactions_count)
+    except Exception:
+        # Exceptions may refer to compiled patterns, which cannot be sent back to the main process
+        raise Exception(traceback.format_exc())
+    finally:
+        if prefetcher:
+            prefetcher.close()
+    traces = {}
+    if args.save:
+        for transaction in transactions:
+            traces[transaction["hash"]] = execution_trace["traces"].pop(transaction["hash"])
+    renderings, cfg_export.deferred_renderings = cfg_export.deferred_renderings, []
+    return results, traces, renderings
+
 def main():
     execution_begin = time.time()
     connection = None
@@ -226,9 +346,23 @@ def main():
         parser.add_argument(
             "-r", "--results", type=str, help="folder where results should be stored")
         parser.add_argument(
-            "--cfg", type=str, help="save control flow graph to a file")
+            "--cfg", type=str, help="save the control flow graph of each transaction to a file: 'dot', 'jsonl', 'graphml', or a Graphviz output format such as 'pdf' rendered from DOT in background")
         parser.add_argument(
             "--debug", action="store_true", help="print debug information to the console")
+        parser.add_argument(
+            "--prefetch", type=int, help="number of traces retrieved ahead of the analysis, 0 disables prefetching (default: "+str(settings.PREFETCH_DEPTH)+")")
+        parser.add_argument(
+            "--prefetch-memory", type=int, help="size in MB above which no further traces are retrieved ahead (default: "+str(settings.PREFETCH_MEMORY // 1024 // 1024)+")")
+        parser.add_argument(
+            "--workers", type=int, help="number of processes analyzing bins of independent transactions in parallel (default: "+str(settings.WORKERS)+")")
+        parser.add_argument(
+            "--screen", action="store_true", help="retrieve the call structure of every transaction first and skip the transactions it rules out for every pattern, which are marked as screened in the results")
+        parser.add_argument(
+            "--shape-traces", action="store_true", help="retrieve traces with a JavaScript tracer emitting memory only on the steps the patterns read it, instead of retrieving memory on every step")
+        parser.add_argument(
+            "--trace-cache", type=str, help="folder where retrieved traces are cached across runs, such as '~/.cache/aegis/traces'")
+        parser.add_argument(
+            "--trace-cache-size", type=int, help="size in MB above which the least recently read cached traces are removed (default: "+str(settings.TRACE_CACHE_SIZE // 1024 // 1024)+")")
         parser.add_argument(
             "--host", type=str, help="HTTP-RPC server listening interface (default: '"+settings.RPC_HOST+"')")
         parser.add_argument(
@@ -246,6 +380,27 @@ def main():
         else:
             settings.PATTERNS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), settings.PATTERNS_FILE)
             
+        if args.prefetch is not None:
+            settings.PREFETCH_DEPTH = args.prefetch
+
+        if args.prefetch_memory is not None:
+            settings.PREFETCH_MEMORY = args.prefetch_memory * 1024 * 1024
+
+        if args.workers:
+            settings.WORKERS = args.workers
+
+        if args.screen:
+            settings.SCREEN_TRANSACTIONS = True
+
+        if args.shape_traces:
+            settings.SHAPE_TRACES = True
+
+        if args.trace_cache:
+            settings.TRACE_CACHE = os.path.expanduser(args.trace_cache)
+
+        if args.trace_cache_size:
+            settings.TRACE_CACHE_SIZE = args.trace_cache_size * 1024 * 1024
+
         if args.host:
             settings.RPC_HOST = args.host
 
@@ -259,6 +414,8 @@ def main():
             try:
                 tries += 1
                 if not args.load:
+                    import http.client
+                    from web3 import Web3
                     settings.W3 = Web3(Web3.HTTPProvider("http://"+settings.RPC_HOST+":"+str(settings.RPC_PORT)))
                     if settings.W3.isConnected():
                         network = ""
@@ -353,6 +510,7 @@ def main():
                 if args.load:
                     transactions = execution_trace["transactions"]
                 else:
+                    import requests
                     api_network = "api" if network == "mainnet" else "api-"+network
                     tries = 0
                     while tries < 10:
@@ -450,6 +608,7 @@ def main():
         if connection:
             connection.close()
             print("Connection closed.")
+        cfg_export.wait_for_renderings()
 
     execution_end = time.time()
     execution_delta = execution_end - execution_begin
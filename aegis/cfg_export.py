@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import subprocess
+
+from xml.sax.saxutils import escape, quoteattr
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+
+# Formats control flow graphs are written in, any other format is rendered by Graphviz from DOT
+CFG_FORMATS = ["dot", "jsonl", "graphml"]
+
+COLORSCHEME = ["paleturquoise", "darkseagreen", "wheat", "violet", "deepskyblue", "mediumpurple", "limegreen", "goldenrod", "steelblue"]
+
+# Width of instruction addresses in DOT labels, code being small enough for 8 hex digits
+ADDRESS_WIDTH = 10
+
+def vertex_id(contract, start, creation):
+    """ Returns the id of a basic block, creation code being told apart from the runtime code at the same address """
+    return str(contract)+':'+hex(start)+(':creation' if creation else '')
+
+class CFGWriter:
+    def __init__(self, filename):
+        """ Writes the basic blocks a transaction executes and the edges leaving them to a file as the blocks end,
+        every block and every edge once, counting the number of times each edge is taken """
+        self.file = open(filename, 'w')
+        self.vertices = set()
+        self.edges = {}
+        self.write_header()
+
+    def add_block(self, basic_block, edge):
+        """ Adds a basic block that ended, and the edge it left through, if any """
+        key = (basic_block.get_contract_address(), basic_block.get_start_address(), basic_block.get_creation())
+        if not key in self.vertices:
+            self.vertices.add(key)
+            self.write_vertex(basic_block)
+        if edge is not None:
+            if not (key, edge) in self.edges:
+                self.edges[(key, edge)] = 0
+                self.write_edge(key, edge)
+            self.edges[(key, edge)] += 1
+
+    def close(self):
+        self.write_footer()
+        self.file.close()
+
+    def write_header(self):
+        pass
+
+    def write_vertex(self, basic_block):
+        pass
+
+    def write_edge(self, key, edge):
+        pass
+
+    def write_footer(self):
+        pass
+
+class DOTWriter(CFGWriter):
+    def __init__(self, filename):
+        self.legend = {}
+        super().__init__(filename)
+
+    def write_header(self):
+        self.file.write('digraph horus_cfg {\n')
+        self.file.write('rankdir = LR;\n')
+        self.file.write('size = "240"\n')
+        self.file.write('graph[fontname = Courier, fontsize = 14.0, labeljust = l, nojustify = true];node[shape = record];\n')
+
+    def write_vertex(self, basic_block):
+        contract = basic_block.get_contract_address()
+        label = '"'+vertex_id(contract, basic_block.get_start_address(), basic_block.get_creation())+'"[label="'
+        for address in basic_block.get_instructions():
+            label += "{0:#0{1}x}".format(address, ADDRESS_WIDTH)+" "+basic_block.get_instructions()[address]+"\\l"
+        if basic_block.get_depth() == 0:
+            self.file.write(label+'",style=filled,style=dashed,fillcolor=white];\n')
+        else:
+            self.file.write(label+'",style=filled,fillcolor='+COLORSCHEME[int(contract, 16) % len(COLORSCHEME)]+'];\n')
+        if not contract in self.legend:
+            self.legend[contract] = COLORSCHEME[int(contract, 16) % len(COLORSCHEME)]
+
+    def write_edge(self, key, edge):
+        if edge[2] == "True":
+            color = "green"
+        elif edge[2] == "False":
+            color = "red"
+        else:
+            color = "black"
+        self.file.write('"'+vertex_id(*key)+'" -> "'+vertex_id(edge[0], edge[1], edge[3])+'" [label="'+edge[2]+'",color="'+color+'"];\n')
+
+    def write_footer(self):
+        # Draw a legend
+        self.file.write('subgraph cluster_legend {\n')
+        self.file.write('label = "Contracts";\n')
+        for contract in self.legend:
+            self.file.write('"'+str(contract)+'"[label="'+str(contract)+'",style=filled,fillcolor='+self.legend[contract]+'];\n')
+        self.file.write('}\n')
+        self.file.write('}\n')
+
+class JSONLinesWriter(CFGWriter):
+    """ Writes one JSON object per block as blocks end, and one per edge once the number of times it was taken is known """
+    def write_vertex(self, basic_block):
+        instructions = basic_block.get_instructions()
+        self.file.write(json.dumps({"type": "block", "contract": basic_block.get_contract_address(), "start": basic_block.get_start_address(), "end": basic_block.get_end_address(), "depth": basic_block.get_depth(), "creation": basic_block.get_creation(), "instructions": [[address, instructions[address]] for address in instructions]})+"\n")
+
+    def write_footer(self):
+        for (key, edge), count in self.edges.items():
+            self.file.write(json.dumps({"type": "edge", "contract": key[0], "start": key[1], "creation": key[2], "to_contract": edge[0], "to_start": edge[1], "to_creation": edge[3], "label": edge[2], "count": count})+"\n")
+
+class GraphMLWriter(CFGWriter):
+    """ Writes blocks as they end, and edges once the number of times they were taken is known """
+    def write_header(self):
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        for key, domain, type in [("contract", "node", "string"), ("start", "node", "long"), ("end", "node", "long"), ("depth", "node", "int"), ("creation", "node", "boolean"), ("instructions", "node", "string"), ("label", "edge", "string"), ("count", "edge", "long")]:
+            self.file.write('<key id="'+key+'" for="'+domain+'" attr.name="'+key+'" attr.type="'+type+'"/>\n')
+        self.file.write('<graph id="cfg" edgedefault="directed">\n')
+
+    def write_vertex(self, basic_block):
+        instructions = basic_block.get_instructions()
+        self.file.write('<node id='+quoteattr(vertex_id(basic_block.get_contract_address(), basic_block.get_start_address(), basic_block.get_creation()))+'>')
+        self.file.write('<data key="contract">'+escape(str(basic_block.get_contract_address()))+'</data>')
+        self.file.write('<data key="start">'+str(basic_block.get_start_address())+'</data>')
+        self.file.write('<data key="end">'+str(basic_block.get_end_address())+'</data>')
+        self.file.write('<data key="depth">'+str(basic_block.get_depth())+'</data>')
+        self.file.write('<data key="creation">'+str(basic_block.get_creation()).lower()+'</data>')
+        self.file.write('<data key="instructions">'+escape("\n".join(hex(address)+" "+instructions[address] for address in instructions))+'</data>')
+        self.file.write('</node>\n')
+
+    def write_footer(self):
+        for (key, edge), count in self.edges.items():
+            self.file.write('<edge source='+quoteattr(vertex_id(*key))+' target='+quoteattr(vertex_id(edge[0], edge[1], edge[3]))+'>')
+            self.file.write('<data key="label">'+escape(edge[2])+'</data><data key="count">'+str(count)+'</data></edge>\n')
+        self.file.write('</graph>\n')
+        self.file.write('</graphml>\n')
+
+CFG_WRITERS = {"dot": DOTWriter, "jsonl": JSONLinesWriter, "graphml": GraphMLWriter}
+
+def open_cfg_writer(filename, extension):
+    """ Returns the writer of a control flow graph saved with the given extension, rendered ones being written as DOT """
+    format = extension if extension in CFG_FORMATS else "dot"
+    return CFG_WRITERS[format](filename+"."+format)
+
+class GraphvizRenderer:
+    def __init__(self, workers):
+        """ Renders DOT files with Graphviz in background, running at most workers Graphviz processes at a time """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.renderings = []
+
+    def render(self, filename, extension):
+        command = ["dot", filename+".dot", "-T"+extension, "-o", filename+"."+extension]
+        self.renderings.append((filename, self.executor.submit(subprocess.call, command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)))
+
+    def wait(self):
+        for filename, rendering in self.renderings:
+            if rendering.result() != 0:
+                print("Could not render the control flow graph "+filename+".dot with Graphviz.")
+        self.renderings = []
+
+renderer = None
+# Renderings requested by a worker process, which are left to the main process
+deferred_renderings = None
+
+def render_control_flow_graph(filename, extension):
+    global renderer
+    if deferred_renderings is not None:
+        deferred_renderings.append((filename, extension))
+        return
+    if renderer is None:
+        if not shutil.which("dot"):
+            print("Graphviz is not available. Please install Graphviz from https://www.graphviz.org/download/.")
+            return
+        renderer = GraphvizRenderer(settings.CFG_RENDER_WORKERS)
+    renderer.render(filename, extension)
+
+def wait_for_renderings():
+    """ Waits for the control flow graphs being rendered in background """
+    if renderer is not None and renderer.renderings:
+        print("Waiting for "+str(len(renderer.renderings))+" control flow graph(s) to be rendered.")
+        renderer.wait()
@@ -2,19 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import time
-import copy
-import subprocess
+import bisect
 import settings
 
-from web3 import Web3
-from utils import normalize_32_byte_hex_address
+from array import array
+from utils import normalize_32_byte_hex_address, convert_wei_to_ether, read_memory
 
 class BasicBlock:
+    __slots__ = ["start_address", "end_address", "depth", "contract_address", "creation", "instructions"]
+
     def __init__(self):
         self.start_address    = 0
         self.end_address      = 0
         self.depth            = 0
         self.contract_address = 0
+        self.creation         = False
         self.instructions     = {}
     def __str__(self):
         string  = "---------Basic Block---------\n"
@@ -26,9 +28,9 @@ class BasicBlock:
         string += "-----------------------------"
         return string
     def __hash__(self):
-        return hash(str(self))
+        return hash((self.contract_address, self.start_address, self.creation))
     def __eq__(self, _other):
-        return self.__dict__ == _other.__dict__
+        return all(getattr(self, name) == getattr(_other, name) for name in self.__slots__)
 
     def set_start_address(self, start_address):
         self.start_address = start_address
@@ -54,6 +56,12 @@ class BasicBlock:
     def get_contract_address(self):
         return self.contract_address
 
+    def set_creation(self, creation):
+        self.creation = creation
+
+    def get_creation(self):
+        return self.creation
+
     def add_instruction(self, key, value):
         self.instructions[key] = value
 
@@ -62,15 +70,35 @@ class BasicBlock:
 
 class ControlFlowGraph:
     def __init__(self):
-        self.edges = {}
         self.graphs = {}
+        # Basic blocks by contract address, start address and whether they are creation code
         self.vertices = {}
+        # Blocks whose recorded execution was cut short by an error, which are recorded again
+        self.failed_blocks = set()
+        self.recording = False
+        # Writes the blocks of the transaction being analyzed as they end, if the graph is saved
+        self.writer = None
         self.callstack = []
+        # Whether the frames on the call stack run the creation code of their contract
+        self.creation_callstack = []
         self.bytecodes = {}
-        self.contract_inputs = {}
-        self.contract_dependencies = {}
+        # Runs of consecutive steps executed by the same contract with the same input, which only change
+        # at calls and returns: the first step of each run, and its contract address and input
+        self.frame_steps = array("Q")
+        self.frame_addresses = []
+        self.frame_inputs = []
+        self.last_step = None
+        # Call frames entered after the step a sweep began at: their entry and return steps in entry order,
+        # and the creator depth and index of the ones the sweep has not seen return yet
+        self.call_entries = array("Q")
+        self.call_exits = array("Q")
+        self.open_calls = []
+        self.sweep_step = None
+        self.sweep_depth = None
         self.current_basic_block = None
         self.current_contract_address = None
+        # Creation code runs at the address of the contract it creates, whose runtime code is another
+        self.current_creation = False
 
     @staticmethod
     def graph_traversal(source, sink, visited):
@@ -87,46 +115,85 @@ class ControlFlowGraph:
                 return False
         return True
 
+    def get_frame(self, step):
+        """ Returns the index of the run of steps holding step """
+        i = bisect.bisect_right(self.frame_steps, step) - 1
+        if i < 0 or step > self.last_step:
+            raise KeyError(step)
+        return i
+
     def get_contract_input(self, step):
-        return self.contract_inputs[step]
+        return self.frame_inputs[self.get_frame(step)]
 
     def get_contract_address(self, step):
-        return self.contract_dependencies[step]
+        return self.frame_addresses[self.get_frame(step)]
+
+    def get_call_exit(self, trace, step):
+        """ Returns the first step after the call frame entered at step returns. Steps are swept forward once,
+        recording every frame entered on the way, so nested creations are not scanned again """
+        if self.sweep_step is None or step >= self.sweep_step:
+            # A sweep ends with the return of the frame it began at, hence every frame it recorded has returned
+            self.call_entries, self.call_exits, self.open_calls = array("Q"), array("Q"), []
+            self.sweep_step, self.sweep_depth = step, None
+        i = bisect.bisect_left(self.call_entries, step)
+        while i == len(self.call_entries) or not self.call_exits[i]:
+            depth = trace[self.sweep_step]["depth"]
+            while self.open_calls and self.open_calls[-1][0] >= depth:
+                self.call_exits[self.open_calls.pop()[1]] = self.sweep_step
+            if self.sweep_depth is not None and depth > self.sweep_depth:
+                self.open_calls.append((self.sweep_depth, len(self.call_entries)))
+                self.call_entries.append(self.sweep_step - 1)
+                self.call_exits.append(0)
+            self.sweep_step, self.sweep_depth = self.sweep_step + 1, depth
+        return self.call_exits[i]
 
     def execute(self, trace, step, transaction):
         if not self.current_contract_address:
             self.current_contract_address = transaction["to"]
 
-        self.contract_dependencies[step] = self.current_contract_address
-
         if trace[step]["op"] in ["CALL", "CALLCODE"]:
             offset = 2 * int(trace[step]["stack"][-4], 16)
             size = 2 * int(trace[step]["stack"][-5], 16)
-            self.contract_inputs[step] = ''.join(trace[step]["memory"])[offset:offset+size]
+            contract_input = read_memory(trace[step]["memory"], offset, size)
         elif trace[step]["op"] in ["DELEGATECALL", "STATICCALL"]:
             offset = 2 * int(trace[step]["stack"][-3], 16)
             size = 2 * int(trace[step]["stack"][-4], 16)
-            self.contract_inputs[step] = ''.join(trace[step]["memory"])[offset:offset+size]
-        elif not step-1 in self.contract_inputs:
-            self.contract_inputs[step] = transaction["input"]
+            contract_input = read_memory(trace[step]["memory"], offset, size)
+        elif self.last_step != step-1:
+            contract_input = transaction["input"]
         else:
-            self.contract_inputs[step] = self.contract_inputs[step-1]
+            contract_input = self.frame_inputs[-1]
+
+        if self.last_step != step-1 or self.current_contract_address != self.frame_addresses[-1] or contract_input != self.frame_inputs[-1]:
+            self.frame_steps.append(step)
+            self.frame_addresses.append(self.current_contract_address)
+            self.frame_inputs.append(contract_input)
+        self.last_step = step
 
         if settings.SAVE_CFG:
             if not self.current_basic_block:
-                self.current_basic_block = BasicBlock()
-                self.current_basic_block.set_start_address(trace[step]["pc"])
-                self.current_basic_block.set_depth(trace[step]["depth"])
-            instruction = trace[step]["op"]
-            # Check for push instructions
-            if "PUSH" in instruction and step+1 < len(trace):
-                instruction += " "+hex(int(trace[step+1]["stack"][-1], 16))
-            self.current_basic_block.add_instruction(trace[step]["pc"], instruction)
+                key = (self.current_contract_address, trace[step]["pc"], self.current_creation)
+                # Blocks run the same instructions on every execution, hence they are only recorded once, at the
+                # depth of their first execution
+                self.recording = not key in self.vertices or key in self.failed_blocks
+                if self.recording:
+                    self.current_basic_block = BasicBlock()
+                    self.current_basic_block.set_start_address(trace[step]["pc"])
+                    self.current_basic_block.set_depth(trace[step]["depth"])
+                    self.current_basic_block.set_creation(self.current_creation)
+                else:
+                    self.current_basic_block = self.vertices[key]
+            if self.recording:
+                instruction = trace[step]["op"]
+                # Check for push instructions
+                if "PUSH" in instruction and step+1 in trace:
+                    instruction += " "+hex(int(trace[step+1]["stack"][-1], 16))
+                self.current_basic_block.add_instruction(trace[step]["pc"], instruction)
         # Check for basic block ending instructions
         if trace[step]["op"] in ["STOP", "RETURN", "SELFDESTRUCT", "SUICIDE", "REVERT", "ASSERTFAIL", "JUMP", "JUMPI", "CALL", "CALLCODE", "DELEGATECALL", "STATICCALL", "CREATE", "CREATE2"] or "error" in trace[step]:
             if settings.DEBUG_MODE and step+1 in trace and trace[step]["depth"] < trace[step+1]["depth"]:
                 print("...........................................................................")
-            if settings.SAVE_CFG:
+            if settings.SAVE_CFG and self.recording:
                 self.current_basic_block.set_end_address(trace[step]["pc"])
                 self.current_basic_block.set_contract_address(self.current_contract_address)
 
@@ -137,18 +204,18 @@ class ControlFlowGraph:
                         print(" From: \t "+self.current_contract_address)
                     if trace[step]["depth"] < trace[step+1]["depth"]:
                         self.callstack.append(self.current_contract_address)
+                        self.creation_callstack.append(self.current_creation)
+                        self.current_creation = trace[step]["op"] in ["CREATE", "CREATE2"]
                         if trace[step]["op"] in ["CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"]:
                             self.current_contract_address = normalize_32_byte_hex_address(trace[step]["stack"][-2])
                         else:
-                            i = step + 1
-                            while trace[i]["depth"] > trace[step]["depth"]:
-                                i += 1
-                            self.current_contract_address = normalize_32_byte_hex_address(trace[i]["stack"][-1])
+                            # The address of a created contract is pushed on the stack of its creator once it returns
+                            self.current_contract_address = normalize_32_byte_hex_address(trace[self.get_call_exit(trace, step)]["stack"][-1])
                     if settings.DEBUG_MODE:
                         print(" To: \t "+self.current_contract_address)
                         if trace[step]["op"] in ["CALL", "CALLCODE"]:
-                            print(" Value:  "+str(Web3.fromWei(int(trace[step]["stack"][-3], 16), "ether"))+" ether")
-                        print(" Input:  0x"+self.contract_inputs[step])
+                            print(" Value:  "+str(convert_wei_to_ether(int(trace[step]["stack"][-3], 16)))+" ether")
+                        print(" Input:  0x"+self.get_contract_input(step))
                         if trace[step+1]["stack"]:
                             print(" Return Value: "+str(trace[step+1]["stack"][-1]))
 
@@ -156,100 +223,40 @@ class ControlFlowGraph:
                 if trace[step]["depth"] > trace[step+1]["depth"]:
                     if len(self.callstack) > 0:
                         self.current_contract_address = self.callstack.pop()
+                        self.current_creation = self.creation_callstack.pop()
                     else:
                         self.current_contract_address = transaction["to"]
+                        self.current_creation = False
             if settings.SAVE_CFG:
+                key = (self.current_basic_block.get_contract_address(), self.current_basic_block.get_start_address(), self.current_basic_block.get_creation())
                 # Add basic block to vertices
-                if not self.current_basic_block.get_start_address() in self.vertices:
-                    self.vertices[self.current_basic_block.get_start_address()] = {}
-                self.vertices[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()] = copy.deepcopy(self.current_basic_block)
+                if self.recording:
+                    self.vertices[key] = self.current_basic_block
+                    if "error" in trace[step]:
+                        self.failed_blocks.add(key)
+                    else:
+                        self.failed_blocks.discard(key)
                 # Add basic block to edges
-                if not self.current_basic_block.get_start_address() in self.edges:
-                    self.edges[self.current_basic_block.get_start_address()] = {}
-                if not self.current_basic_block.get_contract_address() in self.edges[self.current_basic_block.get_start_address()]:
-                    self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()] = []
-                if step < len(trace)-1:
+                edge = None
+                if step+1 in trace:
                     # Check for branches
                     if trace[step]["op"] == "JUMPI":
-                        flag = int(trace[step]["stack"][-2], 16)
-                        if flag != 0:
-                            right_edge = {}
-                            right_edge["contract"] = self.current_contract_address
-                            right_edge["pc"] = int(trace[step]["stack"][-1], 16)
-                            right_edge["label"] = "True"
-                            if not right_edge in self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()]:
-                                self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()].append(right_edge)
+                        if int(trace[step]["stack"][-2], 16) != 0:
+                            edge = (self.current_contract_address, int(trace[step]["stack"][-1], 16), "True", self.current_creation)
                         else:
-                            left_edge = {}
-                            left_edge["contract"] = self.current_contract_address
-                            left_edge["pc"] = trace[step+1]["pc"]
-                            left_edge["label"] = "False"
-                            if not left_edge in self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()]:
-                                self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()].append(left_edge)
-                    else:
-                        edge = {}
-                        edge["contract"] = self.current_contract_address
-                        edge["pc"] = trace[step+1]["pc"]
-                        if trace[step]["op"] in ["CALL", "CALLCODE"]:
-                            if not "error" in trace[step]:
-                                edge["label"] = trace[step]["op"]+" (to: "+hex(int(trace[step]["stack"][-2], 16))+", value: "+str(settings.W3.fromWei(int(trace[step]["stack"][-3], 16), 'ether'))+" ETH, input: 0x"+self.contract_inputs[step]+")"
-                            else:
-                                edge["label"] = "Error"
-                        elif trace[step]["op"] in ["DELEGATECALL", "STATICCALL"]:
-                            if not "error" in trace[step]:
-                                edge["label"] = trace[step]["op"]+" (to: "+hex(int(trace[step]["stack"][-2], 16))+", input: 0x"+self.contract_inputs[step]+")"
-                            else:
-                                edge["label"] = "Error"
+                            edge = (self.current_contract_address, trace[step+1]["pc"], "False", self.current_creation)
+                    elif trace[step]["op"] in ["CALL", "CALLCODE"]:
+                        if not "error" in trace[step]:
+                            edge = (self.current_contract_address, trace[step+1]["pc"], trace[step]["op"]+" (to: "+hex(int(trace[step]["stack"][-2], 16))+", value: "+str(convert_wei_to_ether(int(trace[step]["stack"][-3], 16)))+" ETH, input: 0x"+self.get_contract_input(step)+")", self.current_creation)
                         else:
-                            edge["label"] = ""
-                        if not edge in self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()]:
-                            self.edges[self.current_basic_block.get_start_address()][self.current_basic_block.get_contract_address()].append(edge)
-                self.current_basic_block = None
-
-    def save_control_flow_graph(self, filename, extension):
-        colorscheme = ["paleturquoise", "darkseagreen", "wheat", "violet", "deepskyblue", "mediumpurple", "limegreen", "goldenrod", "steelblue"]
-
-        f = open(filename+'.dot', 'w')
-        f.write('digraph horus_cfg {\n')
-        f.write('rankdir = LR;\n')
-        f.write('size = "240"\n')
-        f.write('graph[fontname = Courier, fontsize = 14.0, labeljust = l, nojustify = true];node[shape = record];\n')
-        legend = {}
-        address_width = 10
-        for vertice in self.vertices.values():
-            for contract in vertice:
-                basic_block = vertice[contract]
-                if len(hex(list(basic_block.get_instructions().keys())[-1])) > address_width:
-                    address_width = len(hex(list(basic_block.get_instructions().keys())[-1]))
-        for vertice in self.vertices.values():
-            for contract in vertice:
-                basic_block = vertice[contract]
-                # Draw vertices
-                label = '"'+str(contract)+':'+hex(basic_block.get_start_address())+'"[label="'
-                for address in basic_block.get_instructions():
-                    label += "{0:#0{1}x}".format(address, address_width)+" "+basic_block.get_instructions()[address]+"\l"
-                if basic_block.get_depth() == 0:
-                    f.write(label+'",style=filled,style=dashed,fillcolor=white];\n')
-                else:
-                    f.write(label+'",style=filled,fillcolor='+colorscheme[int(contract, 16) % len(colorscheme)]+'];\n')
-                if not contract in legend:
-                    legend[contract] = colorscheme[int(contract, 16) % len(colorscheme)]
-                # Draw edges
-                if basic_block.get_start_address() in self.edges:
-                    for i in range(len(self.edges[basic_block.get_start_address()][contract])):
-                        if self.edges[basic_block.get_start_address()][contract][i]["label"] == "True":
-                            f.write('"'+str(contract)+':'+hex(basic_block.get_start_address())+'" -> "'+str(self.edges[basic_block.get_start_address()][contract][i]["contract"])+':'+hex(self.edges[basic_block.get_start_address()][contract][i]["pc"])+'" [label="'+self.edges[basic_block.get_start_address()][contract][i]["label"]+'",color="green"];\n')
-                        elif self.edges[basic_block.get_start_address()][contract][i]["label"] == "False":
-                            f.write('"'+str(contract)+':'+hex(basic_block.get_start_address())+'" -> "'+str(self.edges[basic_block.get_start_address()][contract][i]["contract"])+':'+hex(self.edges[basic_block.get_start_address()][contract][i]["pc"])+'" [label="'+self.edges[basic_block.get_start_address()][contract][i]["label"]+'",color="red"];\n')
+                            edge = (self.current_contract_address, trace[step+1]["pc"], "Error", self.current_creation)
+                    elif trace[step]["op"] in ["DELEGATECALL", "STATICCALL"]:
+                        if not "error" in trace[step]:
+                            edge = (self.current_contract_address, trace[step+1]["pc"], trace[step]["op"]+" (to: "+hex(int(trace[step]["stack"][-2], 16))+", input: 0x"+self.get_contract_input(step)+")", self.current_creation)
                         else:
-                            f.write('"'+str(contract)+':'+hex(basic_block.get_start_address())+'" -> "'+str(self.edges[basic_block.get_start_address()][contract][i]["contract"])+':'+hex(self.edges[basic_block.get_start_address()][contract][i]["pc"])+'" [label="'+self.edges[basic_block.get_start_address()][contract][i]["label"]+'",color="black"];\n')
-        # Draw a legend
-        f.write('subgraph cluster_legend {\n');
-        f.write('label = "Contracts";\n');
-        for contract in legend:
-            f.write('"'+str(contract)+'"[label="'+str(contract)+'",style=filled,fillcolor='+legend[contract]+'];\n');
-        f.write('}\n');
-        f.write('}\n')
-        f.close()
-        if not subprocess.call('dot '+filename+'.dot -T'+extension+' -o '+filename+'.'+extension, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0:
-            print("Graphviz is not available. Please install Graphviz from https://www.graphviz.org/download/.")
+                            edge = (self.current_contract_address, trace[step+1]["pc"], "Error", self.current_creation)
+                    else:
+                        edge = (self.current_contract_address, trace[step+1]["pc"], "", self.current_creation)
+                if self.writer is not None:
+                    self.writer.add_block(self.current_basic_block, edge)
+                self.current_basic_block = None
@@ -1,23 +1,47 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from array import array
+
+# Last frame of a subtree whose frame has not returned yet
+OPEN_FRAME = 2**32 - 1
+
 class DynamicCallTree:
     def __init__(self):
-        self.call_dependencies = {}
+        """ Numbers call frames in the order they are entered, each frame keeping the step that entered it (-1 for
+        the first frame of a transaction) and the last frame entered before it returned, such that the frames it
+        calls, directly or not, are the ones numbered in between. Steps of a bin are executed in order from 0 """
+        self.step_frames = array("I")
+        self.frame_calls = array("q")
+        self.frame_exits = array("I")
+        # Frames from the first frame of the current transaction to the frame of the last step
+        self.callstack = []
 
     def check_call_dependency(self, source, sink):
-        if not self.call_dependencies[sink]:
+        """ Returns whether sink is executed in the frame entered at step source, or in a frame it calls """
+        # Frames entered at the first step of a bin are taken as the first frame of a transaction
+        if not source or source + 1 >= len(self.step_frames):
             return False
-        if source == self.call_dependencies[sink]:
-            return True
-        return self.check_call_dependency(source, self.call_dependencies[sink])
+        frame = self.step_frames[source + 1]
+        return self.frame_calls[frame] == source and frame <= self.step_frames[sink] <= self.frame_exits[frame]
+
+    def enter_frame(self, call):
+        self.callstack.append(len(self.frame_calls))
+        self.frame_calls.append(call)
+        self.frame_exits.append(OPEN_FRAME)
+
+    def exit_frame(self):
+        self.frame_exits[self.callstack.pop()] = len(self.frame_calls) - 1
 
     def execute(self, trace, step):
-        if len(self.call_dependencies) == 0 or not step-1 in trace or trace[step]["transaction"] != trace[step-1]["transaction"]:
-            self.call_dependencies[step] = None
+        if len(self.step_frames) == 0 or not step-1 in trace or trace[step]["transaction"] != trace[step-1]["transaction"]:
+            while self.callstack:
+                self.exit_frame()
+            self.enter_frame(-1)
         elif trace[step]["depth"] > trace[step-1]["depth"]:
-            self.call_dependencies[step] = step - 1
+            self.enter_frame(step - 1)
         elif trace[step]["depth"] < trace[step-1]["depth"]:
-            self.call_dependencies[step] = self.call_dependencies[self.call_dependencies[step-1]]
-        else:
-            self.call_dependencies[step] = self.call_dependencies[step-1]
+            self.exit_frame()
+            if not self.callstack:
+                self.enter_frame(-1)
+        self.step_frames.append(self.callstack[-1])
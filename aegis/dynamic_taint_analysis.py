@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import copy
 import json
+import bisect
+import functools
 import traceback
 import settings
 import collections
@@ -29,20 +30,254 @@ def print_storage(storage):
             print("\t" + str(index) + ": " + str(storage[address][index]))
         print("}")
 
+class TaintStack:
+    def __init__(self, top=None, size=0):
+        """ Builds a stack of taint values whose cells are shared between records """
+        # Cells are immutable (value, next) pairs, so a copy only duplicates the top pointer
+        self.top = top
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        values = []
+        cell = self.top
+        while cell:
+            values.append(cell[0])
+            cell = cell[1]
+        return reversed(values)
+
+    def __getitem__(self, index):
+        return self.cell(index)[0]
+
+    def __setitem__(self, index, value):
+        """ Replaces the element at index by rebuilding only the cells above it"""
+        above = []
+        cell = self.top
+        for _ in range(self.position(index)):
+            above.append(cell[0])
+            cell = cell[1]
+        cell = (value, cell[1])
+        for element in reversed(above):
+            cell = (element, cell)
+        self.top = cell
+
+    def position(self, index):
+        """ Returns the distance of index from the top of the stack"""
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError("taint stack index out of range")
+        return self.size - 1 - index
+
+    def cell(self, index):
+        cell = self.top
+        for _ in range(self.position(index)):
+            cell = cell[1]
+        return cell
+
+    def append(self, value):
+        self.top = (value, self.top)
+        self.size += 1
+
+    def pop(self):
+        if not self.top:
+            raise IndexError("pop from empty taint stack")
+        value, self.top = self.top
+        self.size -= 1
+        return value
+
+    def swap(self, depth):
+        """ Exchanges the top element with the element depth positions below it"""
+        above = []
+        cell = self.top
+        for _ in range(depth):
+            above.append(cell[0])
+            cell = cell[1]
+        value = cell[0]
+        cell = (above[0], cell[1])
+        for element in reversed(above[1:]):
+            cell = (element, cell)
+        self.top = (value, cell)
+
+    def copy(self):
+        return TaintStack(self.top, self.size)
+
+# Number of bytes of memory in each page of a TaintMemory, which copies share until they write to it
+PAGE_SIZE = 512
+
+class TaintMemory:
+    def __init__(self):
+        """ Builds a taint map of memory words keyed by their integer offset """
+        # Taint of every written offset and the written offsets in ascending order, by page
+        self.pages = {}
+        # Numbers of the pages in ascending order, and the pages this map changes in place instead of copying them
+        self.page_numbers = []
+        self.owned_pages = set()
+        self.owns_page_numbers = True
+        # Written offsets in the order they were first written, and ranges between offsets first written one after
+        # the other in ascending order, read as tainted by the lower one. Both are only appended to and are shared by
+        # copies, each of which reads as many elements as its length
+        self.order, self.order_length = [], 0
+        self.gaps, self.gaps_length = [], 0
+
+    def __len__(self):
+        return self.order_length
+
+    def __str__(self):
+        return json.dumps(dict(self.items()))
+
+    def items(self):
+        """ Returns the written words as (hexadecimal offset, taint) pairs"""
+        return [(hex(offset).replace("0x", "").zfill(64), self.read_word(offset)) for offset in self.order[:self.order_length]]
+
+    def read_word(self, offset):
+        """ Returns the taint of the word written at offset"""
+        page = self.pages.get(offset // PAGE_SIZE)
+        return page[0].get(offset, 0) if page else 0
+
+    def written(self, offset):
+        page = self.pages.get(offset // PAGE_SIZE)
+        return page is not None and offset in page[0]
+
+    @staticmethod
+    def extend(values, length, value):
+        """ Returns values with value appended to its first length elements, copying them if a copy sharing values
+        appended to it already """
+        if len(values) != length:
+            values = values[:length]
+        values.append(value)
+        return values
+
+    def write(self, offset, taint):
+        """ Sets the taint of the word at offset, copying the page holding it if it is shared"""
+        number = offset // PAGE_SIZE
+        page = self.pages.get(number)
+        if page is None or not offset in page[0]:
+            if self.order_length:
+                last = self.order[self.order_length - 1]
+                if last < offset:
+                    self.gaps = TaintMemory.extend(self.gaps, self.gaps_length, (last, offset))
+                    self.gaps_length += 1
+            self.order = TaintMemory.extend(self.order, self.order_length, offset)
+            self.order_length += 1
+        if page is None:
+            if not self.owns_page_numbers:
+                self.page_numbers = self.page_numbers[:]
+                self.owns_page_numbers = True
+            bisect.insort(self.page_numbers, number)
+            page = self.pages[number] = ({}, [])
+            self.owned_pages.add(number)
+        elif not number in self.owned_pages:
+            page = self.pages[number] = (dict(page[0]), page[1][:])
+            self.owned_pages.add(number)
+        if not offset in page[0]:
+            bisect.insort(page[1], offset)
+        page[0][offset] = taint
+
+    def written_between(self, low, high):
+        """ Returns the written offsets from low up to high, in ascending order"""
+        offsets = []
+        first = bisect.bisect_left(self.page_numbers, low // PAGE_SIZE)
+        last = bisect.bisect_right(self.page_numbers, high // PAGE_SIZE)
+        for number in self.page_numbers[first:last]:
+            page_offsets = self.pages[number][1]
+            offsets.extend(page_offsets[bisect.bisect_left(page_offsets, low):bisect.bisect_right(page_offsets, high)])
+        return offsets
+
+    def count_between(self, low, high):
+        """ Returns the number of written offsets from low up to high"""
+        count = 0
+        first = bisect.bisect_left(self.page_numbers, low // PAGE_SIZE)
+        last = bisect.bisect_right(self.page_numbers, high // PAGE_SIZE)
+        for number in self.page_numbers[first:last]:
+            page_offsets = self.pages[number][1]
+            count += bisect.bisect_right(page_offsets, high) - bisect.bisect_left(page_offsets, low)
+        return count
+
+    def covers(self, low, high, offset, length):
+        """ Returns whether one of the length words read every 32 bytes from offset starts strictly between low and
+        high without having been written itself"""
+        first = max(0, (low - offset) // 32 + 1)
+        last = min(length - 1, (high - offset - 1) // 32)
+        if first > last:
+            return False
+        # More words than written offsets in between means one of them was not written
+        if last - first + 1 > self.count_between(offset + 32 * first, offset + 32 * last):
+            return True
+        return any(not self.written(offset + 32 * i) for i in range(first, last + 1))
+
+    def sources(self, offset, size):
+        """ Returns the written offsets whose taint is read by the words every 32 bytes from offset up to
+        offset + size. A word that was not written reads the lower offset of every gap it falls in, and the
+        last written offset if it starts below it"""
+        sources = []
+        length = size // 32
+        if size % 32 != 0:
+            length += 1
+        if length <= 0 or not self.order_length:
+            return sources
+        for written in self.written_between(offset, offset + 32 * (length - 1)):
+            if (written - offset) % 32 == 0:
+                sources.append(written)
+        for i in range(self.gaps_length):
+            low, high = self.gaps[i]
+            if self.covers(low, high, offset, length):
+                sources.append(low)
+        last = self.order[self.order_length - 1]
+        if self.covers(offset - 1, last, offset, length):
+            sources.append(last)
+        return sources
+
+    def read(self, offset, size):
+        """ Returns the taint of the words every 32 bytes from offset up to offset + size"""
+        taint = 0
+        for source in self.sources(offset, size):
+            taint |= self.read_word(source)
+        return taint
+
+    def slice(self, offset, size):
+        """ Returns the tainted words read from offset up to offset + size, rebased to offset 0"""
+        memory = TaintMemory()
+        for source in sorted(set(self.sources(offset, size))):
+            if self.read_word(source):
+                memory.write(source - offset, self.read_word(source))
+        return memory
+
+    def spread(self, taint):
+        """ Adds taint to every written word"""
+        for number in self.page_numbers:
+            words, offsets = self.pages[number]
+            # Offsets stay the same, hence they remain shared as they were
+            self.pages[number] = ({offset: words[offset] | taint for offset in words}, offsets)
+
+    def copy(self):
+        """ Returns a copy sharing every page with this map, which then copies the pages it writes to as well"""
+        memory = TaintMemory()
+        memory.pages = dict(self.pages)
+        memory.page_numbers = self.page_numbers
+        memory.owns_page_numbers = self.owns_page_numbers = False
+        self.owned_pages = set()
+        memory.order, memory.order_length = self.order, self.order_length
+        memory.gaps, memory.gaps_length = self.gaps, self.gaps_length
+        return memory
+
 class TaintRecord:
-    def __init__(self, input={}, value=False, output=None, address=None):
+    def __init__(self, input=None, value=0, output=0, address=None, memory=None):
         """ Builds a taint record """
         # Execution environment
-        self.input = input
+        self.input = input if input is not None else TaintMemory()
         self.value = value
         self.output = output
         self.address = address
         # Machine state
-        self.stack = []
-        self.memory = {}
+        self.stack = TaintStack()
+        self.memory = memory if memory is not None else TaintMemory()
+        self.memory_shared = memory is not None
 
     def __str__(self):
-        return json.dumps(self.__dict__)
+        return json.dumps({"input": dict(self.input.items()), "value": self.value, "output": self.output, "address": self.address, "stack": list(self.stack), "memory": dict(self.memory.items())})
 
     def input_tainted(self):
         """ Returns taint value of input data"""
@@ -56,40 +291,51 @@ class TaintRecord:
         """ Returns taint value of stack element at index"""
         if index < len(self.stack):
             return self.stack[index]
-        return False
+        return 0
 
-    def memory_tainted(self, index):
-        """ Returns taint value of memory element at index"""
-        if index in self.memory.keys():
-            return self.memory[index]
-        return False
+    def memory_tainted(self, offset):
+        """ Returns taint value of memory word at offset"""
+        return self.memory.read_word(offset)
+
+    def write_memory(self, offset, value):
+        """ Sets taint value of memory word at offset, copying memory still shared with another record"""
+        if self.memory_shared:
+            self.memory = self.memory.copy()
+            self.memory_shared = False
+        self.memory.write(offset, value)
 
     def clone(self):
         """ Clones this record"""
-        clone = TaintRecord()
-
-        clone.input = copy.deepcopy(self.input)
-        clone.value = copy.deepcopy(self.value)
-        clone.output = copy.deepcopy(self.output)
-        clone.address = copy.deepcopy(self.address)
+        # Taint values are never mutated in place, hence the clone shares them
+        clone = TaintRecord(input=self.input, value=self.value, output=self.output, address=self.address, memory=self.memory)
 
-        clone.stack = copy.deepcopy(self.stack)
-        clone.memory = copy.deepcopy(self.memory)
+        clone.stack = self.stack.copy()
+        self.memory_shared = True
 
         return clone
 
 class TaintRunner:
     def __init__(self):
+        # Number of records kept per call frame
+        self.history = settings.TAINT_HISTORY
         # Machine state
         self.callstack = []
         # World state
         self.storage = {}
+        # Taint sources interned to bit positions of the taint masks
+        self.labels = {}
+        # Until a taint is introduced, and again once no storage is left tainted at the end of a transaction, only
+        # stack heights and addresses of call frames are tracked
+        self.dormant = True
+        self.frames = []
 
     def propagate_taint(self, instruction, contract):
         try:
-            if not "error" in instruction:
+            if self.dormant:
+                self.track_frames(instruction, contract)
+            elif not "error" in instruction:
                 if len(self.callstack) < instruction["depth"]:
-                    self.callstack.append([])
+                    self.callstack.append(collections.deque(maxlen=self.history))
 
                 records = self.callstack[instruction["depth"]-1]
 
@@ -101,7 +347,7 @@ class TaintRunner:
                     else:
                         records.append(TaintRecord(address=contract))
 
-                new_record = TaintRunner.execute_trace(records[-1], self.storage, instruction)
+                new_record = TaintRunner.execute_trace(records[-1], self.storage, instruction, TaintRunner.opcodes.get(instruction["op"]))
                 records.append(new_record)
 
                 if len(self.callstack) > instruction["depth"]:
@@ -109,174 +355,223 @@ class TaintRunner:
         except:
             traceback.print_exc()
 
+    def track_frames(self, instruction, contract):
+        """ Follows the stack height and address of every call frame without propagating taint"""
+        if not "error" in instruction:
+            if len(self.frames) < instruction["depth"]:
+                self.frames.append([0, contract])
+
+            mutator = TaintRunner.stack_taint_table.get(instruction["op"], (0, 0))
+            self.frames[instruction["depth"]-1][0] = len(instruction["stack"]) - mutator[0] + mutator[1]
+
+            if len(self.frames) > instruction["depth"]:
+                del self.frames[-1]
+
+    def awaken(self):
+        """ Switches to full propagation, starting every tracked call frame from an untainted record"""
+        self.callstack = []
+        for height, address in self.frames:
+            record = TaintRecord(address=address)
+            for _ in range(height):
+                record.stack.append(0)
+            self.callstack.append(collections.deque([record], maxlen=self.history))
+        self.frames = []
+        self.dormant = False
+
+    def label(self, taint):
+        """ Returns the taint mask of source taint, interning it on first use"""
+        if not taint in self.labels:
+            self.labels[taint] = 1 << len(self.labels)
+        return self.labels[taint]
+
     def introduce_taint(self, taint, instruction):
         try:
             if not "error" in instruction:
+                if self.dormant:
+                    self.awaken()
                 records = self.callstack[instruction["depth"] - 1]
+                label = self.label(taint)
 
                 mutator = TaintRunner.stack_taint_table[instruction["op"]]
                 for i in range(1, mutator[1] + 1):
-                    if not records[-1].stack[-i]:
-                        records[-1].stack[-i] = [taint]
-                    else:
-                        record = copy.deepcopy(records[-1].stack[-i])
-                        if not taint in record:
-                            record.append(taint)
-                        records[-1].stack[-i] = record
+                    records[-1].stack[-i] |= label
 
                 if instruction["op"] in ["CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"]:
-                    if not records[-1].output:
-                        records[-1].output = []
-                    records[-1].output += [taint]
+                    records[-1].output |= label
                 elif instruction["op"] == "CALLDATACOPY":
-                    records[-1].memory[instruction["stack"][-1]] = []
-                    records[-1].memory[instruction["stack"][-1]].append(taint)
+                    records[-1].write_memory(int(instruction["stack"][-1], 16), label)
                 elif instruction["op"].startswith("MSTORE"):
-                    records[-1].memory[instruction["stack"][-1]] = []
-                    records[-1].memory[instruction["stack"][-1]].append(taint)
+                    records[-1].write_memory(int(instruction["stack"][-1], 16), label)
                 elif instruction["op"] == "SSTORE":
-                    self.storage[records[-1].address][instruction["stack"][-1]] = []
-                    self.storage[records[-1].address][instruction["stack"][-1]].append(taint)
+                    if not records[-1].address in self.storage:
+                        self.storage[records[-1].address] = {}
+                    self.storage[records[-1].address][instruction["stack"][-1]] = label
         except:
             traceback.print_exc()
 
     def check_taint(self, source, instruction):
         try:
             if not "error" in instruction:
+                if not source in self.labels:
+                    return False
                 records = self.callstack[instruction["depth"]-1]
-                values = []
+                values = 0
                 if instruction["op"] == "SLOAD":
                     address = records[-2].address
                     index = instruction["stack"][-1]
-                    if address in self.storage and index in self.storage[address] and self.storage[address][index]:
+                    if address in self.storage and index in self.storage[address]:
                         values = self.storage[address][index]
-                    record = records[-2].stack[-1]
-                    if record:
-                        values += record
+                    values |= records[-2].stack[-1]
                 else:
-                    mutator = TaintRunner.stack_taint_table[instruction["op"]]
-                    for i in range(0, mutator[0]):
-                        record = records[-2].stack[-(i+1)]
-                        if instruction["op"] in TaintRunner.memory_access:
-                            if not i in TaintRunner.memory_access[instruction["op"]]:
-                                if record:
-                                    values += record
-                        else:
-                            if record:
-                                values += record
-                    if instruction["op"] in TaintRunner.memory_access:
-                        mutator = TaintRunner.memory_access[instruction["op"]]
-                        offset  = int(instruction["stack"][-(mutator[0]+1)], 16)
-                        size    = int(instruction["stack"][-(mutator[1]+1)], 16)
-                        taint   = TaintRunner.extract_taint_from_memory(records[-2].memory, offset, size)
-                        if taint:
-                            values += taint
-                for value in values:
-                    if value == source:
-                        return True
-                return False
+                    positions, memory = TaintRunner.check_table[TaintRunner.opcodes[instruction["op"]]]
+                    for position in positions:
+                        values |= records[-2].stack[position]
+                    if memory:
+                        offset  = int(instruction["stack"][memory[0]], 16)
+                        size    = int(instruction["stack"][memory[1]], 16)
+                        values |= records[-2].memory.read(offset, size)
+                return values & self.labels[source] != 0
         except:
             traceback.print_exc()
 
     def clear_taint(self):
         self.callstack = []
+        self.frames = []
+        self.compact_labels()
+        # Records do not outlive their transaction, hence without a source left in storage the next one starts untainted
+        self.dormant = not self.labels
+
+    def compact_labels(self):
+        """ Forgets the sources no longer tainting storage, which no record is left to carry, and renumbers the
+        others from the lowest bit so that taint masks stay as narrow as the live sources"""
+        live = 0
+        for address in self.storage:
+            for index in self.storage[address]:
+                live |= self.storage[address][index]
+        if live == (1 << len(self.labels)) - 1:
+            return
+        bits, labels = {}, {}
+        for source, label in self.labels.items():
+            if live & label:
+                bits[label] = labels[source] = 1 << len(labels)
+        self.labels = labels
+        for address in self.storage:
+            for index, taint in self.storage[address].items():
+                compacted = 0
+                while taint:
+                    label = taint & -taint
+                    compacted |= bits[label]
+                    taint ^= label
+                self.storage[address][index] = compacted
 
     @staticmethod
-    def execute_trace(record, storage, instruction):
+    def execute_trace(record, storage, instruction, opcode=None):
         assert len(record.stack) == len(instruction["stack"])
 
+        if opcode is None:
+            opcode = TaintRunner.opcodes.get(instruction["op"])
+
         new_record = record.clone()
         # Apply Change
-        op = instruction["op"]
-
-        if op.startswith("PUSH"):
-            TaintRunner.mutate_push(new_record)
-        elif op.startswith("DUP"):
-            TaintRunner.mutate_dup(new_record, op)
-        elif op.startswith("SWAP"):
-            TaintRunner.mutate_swap(new_record, op)
-        elif op == "MLOAD":
-            TaintRunner.mutate_mload(new_record, instruction)
-        elif op.startswith("MSTORE"):
-            TaintRunner.mutate_mstore(new_record, instruction)
-        elif op == "SLOAD":
-            TaintRunner.mutate_sload(new_record, storage, instruction)
-        elif op == "SSTORE":
-            TaintRunner.mutate_sstore(new_record, storage, instruction)
-        elif op.startswith("LOG"):
-            TaintRunner.mutate_log(new_record, op)
-        elif op == "SHA3":
-            TaintRunner.mutate_sha3(new_record, instruction)
-        elif op == "CALLVALUE":
-            TaintRunner.mutate_call_value(new_record, instruction)
-        elif op == "CALLDATALOAD":
-            TaintRunner.mutate_call_data_load(new_record, instruction)
-        elif op in ("CALLDATACOPY", "CODECOPY", "RETURNDATACOPY", "EXTCODECOPY"):
-            TaintRunner.mutate_copy(new_record, op, instruction)
-        elif op == "CREATE":
-            TaintRunner.mutate_create(new_record, instruction)
-        elif op in ("CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"):
-            TaintRunner.mutate_call(new_record, op, instruction)
-        elif op == "RETURNDATASIZE":
-            TaintRunner.mutate_return_data_size(new_record, op, instruction)
-        elif op in TaintRunner.stack_taint_table.keys():
-            mutator = TaintRunner.stack_taint_table[op]
-            TaintRunner.mutate_stack(new_record, mutator)
+        mutator = TaintRunner.dispatch_table[opcode] if opcode is not None else None
+        if mutator:
+            mutator(new_record, storage, instruction)
         else:
             if settings.DEBUG_MODE:
-                print("Unknown operation encountered: {}".format(op))
+                print("Unknown operation encountered: {}".format(instruction["op"]))
 
         return new_record
 
     @staticmethod
-    def mutate_stack(record, mutator):
-        taint = False
+    def build_dispatch_table():
+        """ Builds the table of mutators indexed by opcode, with their operands pre-bound"""
+        table = [None] * 256
+        for op in TaintRunner.stack_taint_table:
+            opcode = TaintRunner.opcodes[op]
+            if op.startswith("PUSH"):
+                table[opcode] = TaintRunner.mutate_push
+            elif op.startswith("DUP"):
+                table[opcode] = functools.partial(TaintRunner.mutate_dup, depth=int(op[3:]))
+            elif op.startswith("SWAP"):
+                table[opcode] = functools.partial(TaintRunner.mutate_swap, depth=int(op[4:]))
+            elif op.startswith("LOG"):
+                table[opcode] = functools.partial(TaintRunner.mutate_log, topics=int(op[3:]))
+            elif op == "MLOAD":
+                table[opcode] = TaintRunner.mutate_mload
+            elif op in ("MSTORE", "MSTORE8"):
+                table[opcode] = TaintRunner.mutate_mstore
+            elif op == "SLOAD":
+                table[opcode] = TaintRunner.mutate_sload
+            elif op == "SSTORE":
+                table[opcode] = TaintRunner.mutate_sstore
+            elif op == "SHA3":
+                table[opcode] = TaintRunner.mutate_sha3
+            elif op == "CALLVALUE":
+                table[opcode] = TaintRunner.mutate_call_value
+            elif op == "CALLDATALOAD":
+                table[opcode] = TaintRunner.mutate_call_data_load
+            elif op in ("CALLDATACOPY", "CODECOPY", "RETURNDATACOPY", "EXTCODECOPY"):
+                table[opcode] = functools.partial(TaintRunner.mutate_copy, arguments=TaintRunner.stack_taint_table[op][0])
+            elif op == "CREATE":
+                table[opcode] = TaintRunner.mutate_create
+            elif op in ("CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"):
+                table[opcode] = functools.partial(TaintRunner.mutate_call, value=op in ("CALL", "CALLCODE"), memory=TaintRunner.memory_access[op])
+            elif op == "RETURNDATASIZE":
+                table[opcode] = TaintRunner.mutate_return_data_size
+            else:
+                table[opcode] = functools.partial(TaintRunner.mutate_stack, mutator=TaintRunner.stack_taint_table[op])
+        return table
+
+    @staticmethod
+    def build_check_table():
+        """ Builds the table of stack positions and memory ranges read by each opcode"""
+        table = [None] * 256
+        for op, mutator in TaintRunner.stack_taint_table.items():
+            memory = TaintRunner.memory_access.get(op)
+            positions = tuple(-(i+1) for i in range(mutator[0]) if not memory or not i in memory)
+            if memory:
+                memory = (-(memory[0]+1), -(memory[1]+1))
+            table[TaintRunner.opcodes[op]] = (positions, memory)
+        return table
+
+    @staticmethod
+    def mutate_stack(record, storage, instruction, mutator):
+        taint = 0
         for i in range(mutator[0]):
-            values = record.stack.pop()
-            if values != False:
-                if taint == False:
-                    taint = []
-                for j in range(len(values)):
-                    if not values[j] in taint:
-                        taint.append(values[j])
+            taint |= record.stack.pop()
         for i in range(mutator[1]):
             record.stack.append(taint)
 
     @staticmethod
-    def mutate_push(record):
-        TaintRunner.mutate_stack(record, (0, 1))
+    def mutate_push(record, storage, instruction):
+        record.stack.append(0)
 
     @staticmethod
-    def mutate_dup(record, op):
-        depth = int(op[3:])
-        index = len(record.stack) - depth
-        record.stack.append(record.stack[index])
+    def mutate_dup(record, storage, instruction, depth):
+        record.stack.append(record.stack[-depth])
 
     @staticmethod
-    def mutate_swap(record, op):
-        depth = int(op[4:])
-        l = len(record.stack) - 1
-        i = l - depth
-        record.stack[l], record.stack[i] = record.stack[i], record.stack[l]
+    def mutate_swap(record, storage, instruction, depth):
+        record.stack.swap(depth)
 
     @staticmethod
-    def mutate_mload(record, instruction):
+    def mutate_mload(record, storage, instruction):
         record.stack.pop()
-        index = instruction["stack"][-1]
-        record.stack.append(record.memory_tainted(index))
+        offset = int(instruction["stack"][-1], 16)
+        record.stack.append(record.memory_tainted(offset))
 
     @staticmethod
-    def mutate_mstore(record, instruction):
+    def mutate_mstore(record, storage, instruction):
         record.stack.pop()
-        index, value = instruction["stack"][-1], record.stack.pop()
-        record.memory[index] = value
+        offset, value = int(instruction["stack"][-1], 16), record.stack.pop()
+        record.write_memory(offset, value)
 
     @staticmethod
     def mutate_sload(record, storage, instruction):
         record.stack.pop()
-        taint = False
+        taint = 0
         index = instruction["stack"][-1]
-        if record.address in storage and index in storage[record.address].keys() and storage[record.address][index]:
+        if record.address in storage and index in storage[record.address]:
             taint = storage[record.address][index]
         record.stack.append(taint)
 
@@ -286,176 +581,76 @@ class TaintRunner:
         index, taint = instruction["stack"][-1], record.stack.pop()
         if not record.address in storage:
             storage[record.address] = {}
-        if taint:
-            taint = list(dict.fromkeys(taint))
         storage[record.address][index] = taint
 
     @staticmethod
-    def mutate_log(record, op):
-        depth = int(op[3:])
-        for _ in range(depth + 2):
+    def mutate_log(record, storage, instruction, topics):
+        for _ in range(topics + 2):
             record.stack.pop()
 
     @staticmethod
-    def mutate_sha3(record, instruction):
+    def mutate_sha3(record, storage, instruction):
         record.stack.pop()
         offset = int(instruction["stack"][-1], 16)
         record.stack.pop()
         size = int(instruction["stack"][-2], 16)
-        value = TaintRunner.extract_taint_from_memory(record.memory, offset, size)
+        value = record.memory.read(offset, size)
         record.stack.append(value)
 
     @staticmethod
-    def mutate_call_data_load(record, instruction):
+    def mutate_call_data_load(record, storage, instruction):
         record.stack.pop()
-        taint = False
-        if record.input:
-            if instruction["stack"][-1] in record.input:
-                taint = record.input[instruction["stack"][-1]]
+        taint = record.input.read_word(int(instruction["stack"][-1], 16))
         record.stack.append(taint)
 
     @staticmethod
-    def mutate_call_value(record, instruction):
+    def mutate_call_value(record, storage, instruction):
         record.stack.append(record.value)
 
     @staticmethod
-    def mutate_copy(record, op, instruction):
-        if op == "EXTCODECOPY":
+    def mutate_copy(record, storage, instruction, arguments):
+        # Destination offset follows the address of EXTCODECOPY
+        offset = int(instruction["stack"][-(arguments-2)], 16)
+        for _ in range(arguments - 1):
             record.stack.pop()
-            index = instruction["stack"][-2]
-        else:
-            index = instruction["stack"][-1]
-        record.stack.pop()
-        record.stack.pop()
-        record.memory[index] = record.stack.pop()
+        record.write_memory(offset, record.stack.pop())
 
     @staticmethod
-    def mutate_create(record, instruction):
+    def mutate_create(record, storage, instruction):
         value = record.stack.pop()
         offset = int(instruction["stack"][-1], 16)
         record.stack.pop()
         size = int(instruction["stack"][-2], 16)
         record.stack.pop()
-        taint = TaintRunner.extract_taint_from_memory(record.memory, offset, size)
-        if value and not taint:
-            taint = []
-        if value:
-            taint += value
+        taint = record.memory.read(offset, size) | value
         record.stack.append(taint)
 
     @staticmethod
-    def mutate_call(record, op, instruction):
-        taint = []
-        gas = record.stack.pop()
-        if gas:
-            taint += gas
-        to = record.stack.pop()
-        if to:
-            taint += to
-        value = False
-        if op in ["CALL", "CALLCODE"]:
-            value = record.stack.pop()
+    def mutate_call(record, storage, instruction, value, memory):
+        taint = record.stack.pop()
+        taint |= record.stack.pop()
         if value:
-            taint += value
+            taint |= record.stack.pop()
         record.stack.pop()
         record.stack.pop()
-        in_offset = None
-        in_size = None
-        if op in ["CALL", "CALLCODE"]:
-            in_offset = int(instruction["stack"][-4], 16)
-            in_size = int(instruction["stack"][-5], 16)
-        else:
-            in_offset = int(instruction["stack"][-3], 16)
-            in_size = int(instruction["stack"][-4], 16)
-        record.input = TaintRunner.extract_taint_from_memory_with_addresses(record.memory, in_offset, in_size)
+        in_offset = int(instruction["stack"][-(memory[0]+1)], 16)
+        in_size = int(instruction["stack"][-(memory[1]+1)], 16)
+        record.input = record.memory.slice(in_offset, in_size)
         record.stack.pop()
         record.stack.pop()
-        out_offset = None
-        out_size = None
-        if op in ["CALL", "CALLCODE"]:
-            out_offset = int(instruction["stack"][-6], 16)
-            out_size = int(instruction["stack"][-7], 16)
-        else:
-            out_offset = int(instruction["stack"][-5], 16)
-            out_size = int(instruction["stack"][-6], 16)
-        out_mem_taint = TaintRunner.extract_taint_from_memory(record.memory, out_offset, out_size)
-        if out_mem_taint:
-            taint += out_mem_taint
-        if not taint:
-            taint = False
+        out_offset = int(instruction["stack"][-(memory[0]+3)], 16)
+        out_size = int(instruction["stack"][-(memory[1]+3)], 16)
+        taint |= record.memory.read(out_offset, out_size)
         record.stack.append(taint)
         record.value = taint
-        if record.input and taint:
-            for address in record.input:
-                for value in taint:
-                    if not value in record.input[address]:
-                        record.input[address] += taint
+        if taint:
+            record.input.spread(taint)
         record.output = taint
 
     @staticmethod
-    def mutate_return_data_size(record, op, instruction):
+    def mutate_return_data_size(record, storage, instruction):
         record.stack.append(record.output)
 
-    @staticmethod
-    def extract_taint_from_memory(memory, offset, size):
-        taint = []
-        length = int(size / 32)
-        if size % 32 != 0:
-            length += 1
-        for i in range(length):
-            index = hex(offset + i * 32).replace("0x", "").zfill(64)
-            if index in memory:
-                if memory[index]:
-                    taint += memory[index]
-            else:
-                keys = list(memory.keys())
-                for j in range(len(keys)):
-                    if j < len(keys) - 1:
-                        if int(keys[j], 16) < int(index, 16) and int(index, 16) < int(keys[j+1], 16):
-                            if memory[keys[j]]:
-                                taint += memory[keys[j]]
-                    else:
-                        if int(index, 16) < int(keys[j], 16):
-                            if memory[keys[j]]:
-                                taint += memory[keys[j]]
-        if not taint:
-            taint = False
-        if taint:
-            taint = list(dict.fromkeys(taint))
-        return taint
-
-    @staticmethod
-    def extract_taint_from_memory_with_addresses(memory, offset, size):
-        taint = {}
-        length = int(size / 32)
-        if size % 32 != 0:
-            length += 1
-        for i in range(length):
-            index = hex(offset + i * 32).replace("0x", "").zfill(64)
-            if index in memory:
-                address = int(index, 16) - offset
-                address = hex(address).replace("0x", "").zfill(64)
-                if memory[index]:
-                    taint[address] = memory[index]
-            else:
-                keys = list(memory.keys())
-                for j in range(len(keys)):
-                    if j < len(keys) - 1:
-                        if int(keys[j], 16) < int(index, 16) and int(index, 16) < int(keys[j+1], 16):
-                            if memory[keys[j]]:
-                                address = int(keys[j], 16) - offset
-                                address = hex(address).replace("0x", "").zfill(64)
-                                taint[address] = memory[keys[j]]
-                    else:
-                        if int(index, 16) < int(keys[j], 16):
-                            if memory[keys[j]]:
-                                address = int(keys[j], 16) - offset
-                                address = hex(address).replace("0x", "").zfill(64)
-                                taint[address] = memory[keys[j]]
-        if not taint:
-            taint = False
-        return taint
-
     memory_access = {
         # instruction: (memory offset, memory size)
         'SHA3': (0, 1),
@@ -627,3 +822,161 @@ class TaintRunner:
         'INVALID': (0, 0),
         'SELFDESTRUCT': (1, 0)
     }
+
+    opcodes = {
+        # instruction: opcode
+        # 0s: Stop and Arithmetic Operations
+        'STOP': 0x00,
+        'ADD': 0x01,
+        'MUL': 0x02,
+        'SUB': 0x03,
+        'DIV': 0x04,
+        'SDIV': 0x05,
+        'MOD': 0x06,
+        'SMOD': 0x07,
+        'ADDMOD': 0x08,
+        'MULMOD': 0x09,
+        'EXP': 0x0a,
+        'SIGNEXTEND': 0x0b,
+        # 10s: Comparison & Bitwise Logic Operations
+        'LT': 0x10,
+        'GT': 0x11,
+        'SLT': 0x12,
+        'SGT': 0x13,
+        'EQ': 0x14,
+        'ISZERO': 0x15,
+        'AND': 0x16,
+        'OR': 0x17,
+        'XOR': 0x18,
+        'NOT': 0x19,
+        'BYTE': 0x1a,
+        'SHL': 0x1b,
+        'SHR': 0x1c,
+        'SAR': 0x1d,
+        # 20s: SHA3
+        'SHA3': 0x20,
+        # 30s: Environmental Information
+        'ADDRESS': 0x30,
+        'BALANCE': 0x31,
+        'ORIGIN': 0x32,
+        'CALLER': 0x33,
+        'CALLVALUE': 0x34,
+        'CALLDATALOAD': 0x35,
+        'CALLDATASIZE': 0x36,
+        'CALLDATACOPY': 0x37,
+        'CODESIZE': 0x38,
+        'CODECOPY': 0x39,
+        'GASPRICE': 0x3a,
+        'EXTCODESIZE': 0x3b,
+        'EXTCODECOPY': 0x3c,
+        'RETURNDATASIZE': 0x3d,
+        'RETURNDATACOPY': 0x3e,
+        'EXTCODEHASH': 0x3f,
+        # 40s: Block Information
+        'BLOCKHASH': 0x40,
+        'COINBASE': 0x41,
+        'TIMESTAMP': 0x42,
+        'NUMBER': 0x43,
+        'DIFFICULTY': 0x44,
+        'GASLIMIT': 0x45,
+        # 50s: Stack, Memory, Storage and Flow Operations
+        'POP': 0x50,
+        'MLOAD': 0x51,
+        'MSTORE': 0x52,
+        'MSTORE8': 0x53,
+        'SLOAD': 0x54,
+        'SSTORE': 0x55,
+        'JUMP': 0x56,
+        'JUMPI': 0x57,
+        'PC': 0x58,
+        'MSIZE': 0x59,
+        'GAS': 0x5a,
+        'JUMPDEST': 0x5b,
+        # 60s & 70s: Push Operations
+        'PUSH1': 0x60,
+        'PUSH2': 0x61,
+        'PUSH3': 0x62,
+        'PUSH4': 0x63,
+        'PUSH5': 0x64,
+        'PUSH6': 0x65,
+        'PUSH7': 0x66,
+        'PUSH8': 0x67,
+        'PUSH9': 0x68,
+        'PUSH10': 0x69,
+        'PUSH11': 0x6a,
+        'PUSH12': 0x6b,
+        'PUSH13': 0x6c,
+        'PUSH14': 0x6d,
+        'PUSH15': 0x6e,
+        'PUSH16': 0x6f,
+        'PUSH17': 0x70,
+        'PUSH18': 0x71,
+        'PUSH19': 0x72,
+        'PUSH20': 0x73,
+        'PUSH21': 0x74,
+        'PUSH22': 0x75,
+        'PUSH23': 0x76,
+        'PUSH24': 0x77,
+        'PUSH25': 0x78,
+        'PUSH26': 0x79,
+        'PUSH27': 0x7a,
+        'PUSH28': 0x7b,
+        'PUSH29': 0x7c,
+        'PUSH30': 0x7d,
+        'PUSH31': 0x7e,
+        'PUSH32': 0x7f,
+        # 80s: Duplication Operations
+        'DUP1': 0x80,
+        'DUP2': 0x81,
+        'DUP3': 0x82,
+        'DUP4': 0x83,
+        'DUP5': 0x84,
+        'DUP6': 0x85,
+        'DUP7': 0x86,
+        'DUP8': 0x87,
+        'DUP9': 0x88,
+        'DUP10': 0x89,
+        'DUP11': 0x8a,
+        'DUP12': 0x8b,
+        'DUP13': 0x8c,
+        'DUP14': 0x8d,
+        'DUP15': 0x8e,
+        'DUP16': 0x8f,
+        # 90s: Exchange Operations
+        'SWAP1': 0x90,
+        'SWAP2': 0x91,
+        'SWAP3': 0x92,
+        'SWAP4': 0x93,
+        'SWAP5': 0x94,
+        'SWAP6': 0x95,
+        'SWAP7': 0x96,
+        'SWAP8': 0x97,
+        'SWAP9': 0x98,
+        'SWAP10': 0x99,
+        'SWAP11': 0x9a,
+        'SWAP12': 0x9b,
+        'SWAP13': 0x9c,
+        'SWAP14': 0x9d,
+        'SWAP15': 0x9e,
+        'SWAP16': 0x9f,
+        # a0s: Logging Operations
+        'LOG0': 0xa0,
+        'LOG1': 0xa1,
+        'LOG2': 0xa2,
+        'LOG3': 0xa3,
+        'LOG4': 0xa4,
+        # f0s: System Operations
+        'CREATE': 0xf0,
+        'CREATE2': 0xf5,
+        'CALL': 0xf1,
+        'CALLCODE': 0xf2,
+        'RETURN': 0xf3,
+        'DELEGATECALL': 0xf4,
+        'STATICCALL': 0xfa,
+        'REVERT': 0xfd,
+        'INVALID': 0xfe,
+        'SELFDESTRUCT': 0xff
+    }
+
+TaintRunner.dispatch_table = TaintRunner.build_dispatch_table()
+TaintRunner.check_table = TaintRunner.build_check_table()
@@ -4,9 +4,11 @@
 import os
 import copy
 import time
+import json
+import heapq
+import hashlib
 import settings
 
-from textx import metamodel_from_file
 from utils import *
 
 def load_model(filename):
@@ -14,17 +16,648 @@ def load_model(filename):
         if settings.DEBUG_MODE:
             print("Loading patterns...")
             parsing_begin = time.time()
-        metamodel = metamodel_from_file(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'grammar.tx'), memoization=True)
-        model = metamodel.model_from_file(filename)
+        key = model_key(filename)
+        model = read_cached_model(filename, key)
+        if not model:
+            model = parse_model(filename)
+            write_cached_model(filename, key, model)
+        compile_model(model)
         if settings.DEBUG_MODE:
             parsing_end = time.time()
             parsing_delta = parsing_end - parsing_begin
-            print("Done. Loading patterns took %.2f second(s)." % parsing_delta)
+            print("Done. Loading and compiling patterns took %.2f second(s)." % parsing_delta)
         return model
     except Exception as e:
-        print(e.message)
+        print(e)
     return None
 
+def parse_model(filename):
+    """ Parses a patterns file into plain nodes """
+    from textx import metamodel_from_file
+    metamodel = metamodel_from_file(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'grammar.tx'), memoization=True)
+    return convert_model(metamodel.model_from_file(filename))
+
+def model_key(filename):
+    """ Returns a hash of the grammar, the patterns and this module, which defines the cached nodes """
+    key = hashlib.sha256()
+    for path in [os.path.join(os.path.dirname(os.path.realpath(__file__)), 'grammar.tx'), filename, os.path.realpath(__file__)]:
+        with open(path, 'rb') as file:
+            key.update(hashlib.sha256(file.read()).digest())
+    return key.hexdigest()
+
+def cached_model_path(filename):
+    return os.path.join(settings.PATTERNS_CACHE, hashlib.sha256(os.path.realpath(filename).encode()).hexdigest()[:16]+".json")
+
+def read_cached_model(filename, key):
+    """ Returns the cached model of a patterns file, or None if there is none or it is stale """
+    if not settings.PATTERNS_CACHE:
+        return None
+    try:
+        with open(cached_model_path(filename), 'r') as file:
+            cached = json.load(file)
+        if cached["key"] == key:
+            return decode_model(cached["model"])
+    except Exception:
+        pass
+    return None
+
+def write_cached_model(filename, key, model):
+    if not settings.PATTERNS_CACHE:
+        return
+    try:
+        os.makedirs(settings.PATTERNS_CACHE, exist_ok=True)
+        path = cached_model_path(filename)
+        with open(path+"."+str(os.getpid()), 'w') as file:
+            json.dump({"key": key, "model": encode_model(model)}, file)
+        os.replace(path+"."+str(os.getpid()), path)
+    except Exception as e:
+        if settings.DEBUG_MODE:
+            print("Could not cache patterns: "+str(e))
+
+class Node:
+    def __init__(self, parent=None):
+        """ Plain counterpart of a textX object, with the same class name and attributes, which unlike the latter can be cached """
+        self.parent = parent
+
+class Model(Node): pass
+class Pattern(Node): pass
+class Equal(Node): pass
+class NotEqual(Node): pass
+class GreaterThan(Node): pass
+class LessThan(Node): pass
+class GreaterOrEqual(Node): pass
+class LessOrEqual(Node): pass
+class In(Node): pass
+class Stack(Node): pass
+class Memory(Node): pass
+class Source(Node): pass
+class Destination(Node): pass
+class ControlDependency(Node): pass
+class DataDependency(Node): pass
+class Follows(Node): pass
+class BooleanAnd(Node): pass
+
+NODES = {node.__name__: node for node in Node.__subclasses__()}
+
+def convert_model(element, parent=None):
+    """ Converts a textX model into nodes of the same names and attributes """
+    if isinstance(element, list):
+        return [convert_model(child, parent) for child in element]
+    if not hasattr(element.__class__, "_tx_attrs"):
+        return element
+    node = NODES[element.__class__.__name__](parent)
+    for attribute in element.__class__._tx_attrs:
+        setattr(node, attribute, convert_model(getattr(element, attribute), node))
+    return node
+
+def encode_model(element):
+    """ Returns the JSON form of nodes, a node being an object naming its class and holding its attributes but its parent """
+    if isinstance(element, list):
+        return [encode_model(child) for child in element]
+    if not isinstance(element, Node):
+        return element
+    encoded = {"node": element.__class__.__name__}
+    for attribute, value in vars(element).items():
+        if attribute != "parent":
+            encoded[attribute] = encode_model(value)
+    return encoded
+
+def decode_model(element, parent=None):
+    """ Returns the nodes of a JSON form, with their parents restored """
+    if isinstance(element, list):
+        return [decode_model(child, parent) for child in element]
+    if not isinstance(element, dict):
+        return element
+    node = NODES[element["node"]](parent)
+    for attribute, value in element.items():
+        if attribute != "node":
+            setattr(node, attribute, decode_model(value, node))
+    return node
+
+def get_nodes(node, node_type):
+    """ Returns the nodes of a type contained in a node, including itself """
+    nodes = [node] if node.__class__.__name__ == node_type else []
+    for attribute, value in vars(node).items():
+        if attribute != "parent":
+            for child in value if isinstance(value, list) else [value]:
+                if isinstance(child, Node):
+                    nodes += get_nodes(child, node_type)
+    return nodes
+
+class Context:
+    def __init__(self, trace, taint_runner, call_tree, control_flow_graph, dependencies):
+        """ Holds the execution state compiled patterns are evaluated against """
+        self.trace = trace
+        self.taint_runner = taint_runner
+        self.call_tree = call_tree
+        self.control_flow_graph = control_flow_graph
+        self.dependencies = dependencies
+        self.memo = {}
+
+class SourceIndex:
+    def __init__(self, sources, keys):
+        """ Indexes the sources of a relation by their key, None meaning the key could not be computed """
+        self.sources = sources
+        self.keys = {}
+        self.buckets = {}
+        self.unindexed = []
+        for position in range(len(sources)):
+            self.insert(position, keys[sources[position]])
+
+    @staticmethod
+    def of(relation_dependencies):
+        """ Returns the index of a relation, rebuilding it if its sources have been replaced """
+        index = relation_dependencies.get("index")
+        if not index or not index.sources is relation_dependencies["sources"]:
+            index = relation_dependencies["index"] = SourceIndex(relation_dependencies["sources"], index.keys if index else {})
+        return index
+
+    def insert(self, position, key):
+        self.keys[self.sources[position]] = key
+        if key is None:
+            self.unindexed.append(position)
+        else:
+            self.buckets.setdefault(key, []).append(position)
+
+    def append(self, source, key):
+        self.sources.append(source)
+        self.insert(len(self.sources) - 1, key)
+
+    def candidates(self, key):
+        """ Returns the positions of the sources that can match a key, latest first, and whether
+        they matched through the index """
+        if key is None:
+            return ((position, False) for position in reversed(range(len(self.sources))))
+        matches = ((position, True) for position in reversed(self.buckets.get(key, [])))
+        if not self.unindexed:
+            return matches
+        return heapq.merge(matches, ((position, False) for position in reversed(self.unindexed)), reverse=True)
+
+def compile_model(model):
+    """ Compiles the patterns of a model and indexes them by the opcodes they need to be evaluated on """
+    model.pattern_index, model.unanchored_patterns = {}, []
+    if "patterns" in dir(model):
+        anchors, shared = [], shared_expressions(model.patterns)
+        for pattern in model.patterns:
+            pattern.predicate = compile_pattern(pattern.condition, shared=shared)
+            matches, effects = pattern_opcodes(pattern.condition)
+            anchors.append(None if matches is None or effects is None else matches | effects)
+        for opcodes in anchors:
+            if opcodes is not None:
+                for opcode in opcodes:
+                    model.pattern_index[opcode] = []
+        for pattern, opcodes in zip(model.patterns, anchors):
+            if opcodes is None:
+                model.unanchored_patterns.append(pattern)
+                for opcode in model.pattern_index:
+                    model.pattern_index[opcode].append(pattern)
+            else:
+                for opcode in opcodes:
+                    model.pattern_index[opcode].append(pattern)
+    compile_screens(model)
+    return model
+
+def compile_screens(model):
+    """ Compiles the conditions the call structure of a transaction has to meet for a pattern to be true on it,
+    and for each data dependency, for its source or destination to be true on it """
+    model.screens, model.data_dependencies = [], []
+    if "patterns" in dir(model):
+        for pattern in model.patterns:
+            model.screens.append(compile_screen(pattern.condition))
+            for dependency in get_nodes(pattern.condition, "DataDependency"):
+                model.data_dependencies.append((dependency, compile_screen(dependency.source), compile_screen(dependency.destination)))
+        # Nested data dependencies are screened first, as the ones they are the source of depend on them
+        model.data_dependencies.reverse()
+
+def compile_screen(pattern):
+    """ Compiles a pattern into a screen(summary, dependencies), which is false only if the pattern cannot be true on any step
+    of a transaction, given the summary of its call structure and the data dependencies that can be true on it """
+    pattern_name = pattern.__class__.__name__
+
+    if pattern_name in ["Equal", "In"]:
+        matches = pattern_opcodes(pattern)[0]
+        if matches is not None:
+            return lambda summary, dependencies: not matches.isdisjoint(summary["opcodes"])
+
+    if pattern_name == "BooleanAnd":
+        x, y = compile_screen(pattern.x), compile_screen(pattern.y)
+        return lambda summary, dependencies: x(summary, dependencies) and y(summary, dependencies)
+
+    if pattern_name == "DataDependency":
+        return lambda summary, dependencies: pattern in dependencies
+
+    if pattern_name in ["Follows", "ControlDependency"]:
+        source, destination = compile_screen(pattern.source), compile_screen(pattern.destination)
+        # A destination nested in a call made by a source of the same address is a call back into that address
+        reentrant = pattern_name == "ControlDependency" and any(is_address(x) and is_address(y, True) for x, y in split_where(pattern.condition)[0])
+        return lambda summary, dependencies: source(summary, dependencies) and destination(summary, dependencies) and (not reentrant or summary["reentrant"])
+
+    return lambda summary, dependencies: True
+
+def is_address(pattern, destination=False):
+    """ Returns whether a value of a where clause is the address of the source, or of the destination if destination is set """
+    if destination and pattern == "address":
+        return True
+    return pattern.__class__.__name__ == ("Destination" if destination else "Source") and pattern.property == "address"
+
+def screen_transactions(model, summaries):
+    """ Returns whether each transaction of a bin has to be analyzed, given the summaries of their call structure, None if
+    unknown: either a pattern can be true on it, or it can change the taint that later transactions read from storage """
+    everything = [{"opcodes": frozenset(["SLOAD", "SSTORE"]), "reentrant": True} if summary is None else summary for summary in summaries]
+    every_dependency = set(dependency for dependency, _, _ in model.data_dependencies)
+    # Sources only reach destinations of later transactions through storage, hence the taint of a data dependency
+    # only matters to the transactions that load from storage and can be a destination of it
+    readers, read = [], set()
+    for summary, known in reversed(list(zip(everything, summaries))):
+        readers.append(read)
+        if "SLOAD" in summary["opcodes"]:
+            read = read | set(dependency for dependency, _, destination in model.data_dependencies if known is None or destination(summary, every_dependency))
+    readers.reverse()
+    candidates, stored = [], set()
+    for summary, known, read in zip(everything, summaries, readers):
+        if known is None:
+            # Transactions whose call structure is unknown may meet any condition
+            stored.update(read)
+            candidates.append(True)
+            continue
+        dependencies = set()
+        for dependency, source, destination in model.data_dependencies:
+            if destination(summary, dependencies) and (source(summary, dependencies) or dependency in stored and "SLOAD" in summary["opcodes"]):
+                dependencies.add(dependency)
+        candidate = any(screen(summary, dependencies) for screen in model.screens)
+        if "SSTORE" in summary["opcodes"]:
+            for dependency, source, _ in model.data_dependencies:
+                if dependency in read and source(summary, dependencies):
+                    stored.add(dependency)
+            # Storing can also overwrite the taint left by previous transactions
+            candidate = candidate or bool(stored & read)
+        candidates.append(candidate)
+    return candidates
+
+def pattern_opcodes(pattern):
+    """ Returns the opcodes on which a pattern can be true and the opcodes on which evaluating
+    it can record sources or destinations, None meaning any opcode """
+    pattern_name = pattern.__class__.__name__
+
+    if pattern_name in ["Equal", "In"]:
+        if pattern_name == "In" and pattern.element == "opcode":
+            return (frozenset(pattern.elements), frozenset())
+        for x, y in [(pattern.x, pattern.y), (pattern.y, pattern.x)] if pattern_name == "Equal" else []:
+            if x == "opcode" and isinstance(y, str) and not y in ["opcode", "pc", "depth", "address"] and not "transaction" in y:
+                return (frozenset([y]), frozenset())
+        return (None, frozenset())
+
+    if pattern_name == "BooleanAnd":
+        x_matches, x_effects = pattern_opcodes(pattern.x)
+        y_matches, y_effects = pattern_opcodes(pattern.y)
+        # The right-hand side is only evaluated where the left-hand side holds
+        return (intersect_opcodes(x_matches, y_matches), unite_opcodes(x_effects, intersect_opcodes(x_matches, y_effects)))
+
+    if pattern_name in ["Follows", "DataDependency", "ControlDependency"]:
+        source_matches, source_effects = pattern_opcodes(pattern.source)
+        destination_matches, destination_effects = pattern_opcodes(pattern.destination)
+        effects = unite_opcodes(source_matches, destination_matches)
+        return (destination_matches, unite_opcodes(effects, unite_opcodes(source_effects, destination_effects)))
+
+    return (None, frozenset())
+
+def intersect_opcodes(x, y):
+    if x is None:
+        return y
+    if y is None:
+        return x
+    return x & y
+
+def unite_opcodes(x, y):
+    if x is None or y is None:
+        return None
+    return x | y
+
+def compile_pattern(pattern, relation=None, where=False, shared=None):
+    """ Compiles a pattern into a predicate(context, step, source), where source is the
+    source step bound by the where clause of the enclosing relation """
+    if shared:
+        key = pattern_key(pattern)
+        if key in shared:
+            if not shared[key]:
+                shared[key] = memoize(compile_expression(pattern, relation, where, shared), list(shared).index(key))
+            return shared[key]
+    return compile_expression(pattern, relation, where, shared)
+
+def compile_expression(pattern, relation, where, shared):
+    pattern_name = pattern.__class__.__name__
+
+    if isinstance(pattern, int):
+        return lambda context, step, source: pattern
+
+    if isinstance(pattern, str):
+        if "transaction" in pattern:
+            key = pattern.split('.')[1]
+            return lambda context, step, source: context.trace[step]["transaction"][key]
+        elif pattern in ["pc", "depth"]:
+            return lambda context, step, source: context.trace[step][pattern]
+        elif pattern == "opcode":
+            return lambda context, step, source: context.trace[step]["op"]
+        elif pattern == "address":
+            return lambda context, step, source: context.control_flow_graph.get_contract_address(step)
+        else:
+            return lambda context, step, source: pattern
+
+    if pattern_name in ["GreaterThan", "LessThan", "GreaterOrEqual", "LessOrEqual", "Equal", "NotEqual"]:
+        x, y = compile_operand(pattern.x, relation, where, shared), compile_operand(pattern.y, relation, where, shared)
+        if pattern_name == "GreaterThan":
+            return lambda context, step, source: x(context, step, source) > y(context, step, source)
+        if pattern_name == "LessThan":
+            return lambda context, step, source: x(context, step, source) < y(context, step, source)
+        if pattern_name == "GreaterOrEqual":
+            return lambda context, step, source: x(context, step, source) >= y(context, step, source)
+        if pattern_name == "LessOrEqual":
+            return lambda context, step, source: x(context, step, source) <= y(context, step, source)
+        if pattern_name == "Equal":
+            return lambda context, step, source: x(context, step, source) == y(context, step, source)
+        return lambda context, step, source: x(context, step, source) != y(context, step, source)
+
+    if pattern_name == "BooleanAnd":
+        x, y = compile_pattern(pattern.x, relation, where, shared), compile_pattern(pattern.y, relation, where, shared)
+        return lambda context, step, source: x(context, step, source) and y(context, step, source)
+
+    if pattern_name == "In":
+        element, elements = compile_pattern(pattern.element, relation, where, shared), list(pattern.elements)
+        return lambda context, step, source: element(context, step, source) in elements
+
+    if pattern_name == "Stack":
+        index = -1 - pattern.index
+        def stack(context, step, source):
+            stack = context.trace[step]["stack"]
+            return hex(int(stack[len(stack)+index], 16))
+        return stack
+
+    if pattern_name == "Memory":
+        offset, size = compile_operand(pattern.offset, relation, where, shared), compile_operand(pattern.size, relation, where, shared)
+        def memory(context, step, source):
+            begin, end = 2 * offset(context, step, source), 2 * size(context, step, source)
+            return ''.join(context.trace[step]["memory"])[begin:begin+end]
+        return memory
+
+    if pattern_name in ["Follows", "DataDependency", "ControlDependency"]:
+        return compile_relation(pattern, shared)
+
+    if pattern_name == "Source":
+        property = compile_pattern(pattern.property, relation, where, shared)
+        if where:
+            return lambda context, step, source: property(context, source, source)
+        return lambda context, step, source: property(context, context.dependencies[relation]["dependencies"][0]["source"], source)
+
+    if pattern_name == "Destination":
+        return compile_pattern(pattern.property, relation, where, shared)
+
+    raise Exception("Unknown operation: "+str(pattern_name))
+
+def compile_operand(pattern, relation, where, shared):
+    """ Compiles an operand of a comparison, converting hexadecimal values to integers """
+    if isinstance(pattern, (int, str)) and not pattern in ["pc", "depth", "opcode", "address"] and not "transaction" in str(pattern):
+        value = convert_hex_to_int(pattern)
+        return lambda context, step, source: value
+    if pattern == "opcode":
+        return lambda context, step, source: context.trace[step]["op"]
+    if pattern.__class__.__name__ == "Stack":
+        index = -1 - pattern.index
+        def stack(context, step, source):
+            stack = context.trace[step]["stack"]
+            return int(stack[len(stack)+index], 16)
+        return stack
+    operand = compile_pattern(pattern, relation, where, shared)
+    return lambda context, step, source: convert_hex_to_int(operand(context, step, source))
+
+def compile_relation(pattern, shared):
+    pattern_name = pattern.__class__.__name__
+    source_condition = compile_pattern(pattern.source, pattern, False, shared)
+    destination_condition = compile_pattern(pattern.destination, pattern, False, shared)
+    where_condition = compile_pattern(pattern.condition, pattern, True, shared) if pattern.condition else None
+
+    # Sources are bucketed by the values their side of the equalities in the where clause take,
+    # so that only the sources whose values match the ones of the destination are considered
+    joins, residual = split_where(pattern.condition)
+    source_keys = [compile_operand(x, pattern, True, shared) for x, _ in joins]
+    destination_keys = [compile_operand(y, pattern, True, shared) for _, y in joins]
+    residual_conditions = [compile_pattern(condition, pattern, True, shared) for condition in residual]
+
+    def relation(context, step, source):
+        dependencies = context.dependencies
+        dependency_detected = False
+        if source_condition(context, step, source):
+            if pattern_name == "DataDependency":
+                context.taint_runner.introduce_taint(step, context.trace[step])
+            if not pattern in dependencies:
+                dependencies[pattern] = {}
+                dependencies[pattern]["sources"] = []
+                dependencies[pattern]["destinations"] = []
+                dependencies[pattern]["dependencies"] = []
+                dependencies[pattern]["pairs"] = set()
+            index = SourceIndex.of(dependencies[pattern])
+            if not step in index.keys:
+                try:
+                    key = tuple(source_key(context, step, step) for source_key in source_keys)
+                except Exception:
+                    # Keep the source and let the where clause raise when it is evaluated
+                    key = None
+                index.append(step, key)
+        if destination_condition(context, step, source):
+            if pattern in dependencies:
+                dependencies[pattern]["destinations"].append(step)
+                index = SourceIndex.of(dependencies[pattern])
+                try:
+                    candidates = index.candidates(tuple(destination_key(context, step, None) for destination_key in destination_keys))
+                except Exception:
+                    candidates = index.candidates(None)
+                for position, indexed in candidates:
+                    candidate = index.sources[position]
+                    if candidate != step:
+                        if pattern_name == "DataDependency" and not context.taint_runner.check_taint(candidate, context.trace[step]):
+                            continue
+                        if pattern_name == "ControlDependency" and not context.call_tree.check_call_dependency(candidate, step):
+                            continue
+                        if not (candidate, step) in dependencies[pattern]["pairs"]:
+                            if indexed:
+                                matched = all(condition(context, step, candidate) for condition in residual_conditions)
+                            else:
+                                matched = not where_condition or where_condition(context, step, candidate)
+                            if matched:
+                                dependency = {}
+                                dependency["source"] = candidate
+                                dependency["destination"] = step
+                                dependencies[pattern]["dependencies"].append(dependency)
+                                dependencies[pattern]["pairs"].add((candidate, step))
+                                dependency_detected = True
+                                break
+        return dependency_detected
+
+    return relation
+
+def split_where(condition):
+    """ Splits a where clause into the equalities between a source and a destination value,
+    as (source, destination) pairs, and the remaining conditions """
+    joins, residual = [], []
+    conditions = [condition] if condition else []
+    while conditions:
+        condition = conditions.pop(0)
+        if condition.__class__.__name__ == "BooleanAnd":
+            conditions = [condition.x, condition.y] + conditions
+        elif condition.__class__.__name__ == "Equal" and condition.x.__class__.__name__ == "Source" and not refers_to_source(condition.y):
+            joins.append((condition.x, condition.y))
+        elif condition.__class__.__name__ == "Equal" and condition.y.__class__.__name__ == "Source" and not refers_to_source(condition.x):
+            joins.append((condition.y, condition.x))
+        else:
+            residual.append(condition)
+    return joins, residual
+
+def refers_to_source(pattern):
+    pattern_name = pattern.__class__.__name__
+    if isinstance(pattern, (int, str)) or pattern_name == "Stack":
+        return False
+    if pattern_name in ["Source", "Follows", "DataDependency", "ControlDependency"]:
+        return True
+    if pattern_name == "Destination":
+        return refers_to_source(pattern.property)
+    if pattern_name == "Memory":
+        return refers_to_source(pattern.offset) or refers_to_source(pattern.size)
+    if pattern_name == "In":
+        return refers_to_source(pattern.element)
+    return refers_to_source(pattern.x) or refers_to_source(pattern.y)
+
+def memoize(expression, index):
+    """ Evaluates a shared expression at most once per step and source """
+    def memoized(context, step, source):
+        key = (index, step, source)
+        if key in context.memo:
+            return context.memo[key]
+        value = context.memo[key] = expression(context, step, source)
+        return value
+    return memoized
+
+def pattern_key(pattern):
+    """ Returns a key that is equal for structurally identical patterns """
+    pattern_name = pattern.__class__.__name__
+    if isinstance(pattern, (int, str)):
+        return pattern
+    if pattern_name in ["Follows", "DataDependency", "ControlDependency"]:
+        return (pattern_name, id(pattern))
+    if pattern_name == "Stack":
+        return (pattern_name, pattern.index)
+    if pattern_name == "Memory":
+        return (pattern_name, pattern_key(pattern.offset), pattern_key(pattern.size))
+    if pattern_name in ["Source", "Destination"]:
+        return (pattern_name, pattern_key(pattern.property))
+    if pattern_name == "In":
+        return (pattern_name, pattern_key(pattern.element), tuple(pattern.elements))
+    return (pattern_name, pattern_key(pattern.x), pattern_key(pattern.y))
+
+def shared_expressions(patterns):
+    """ Returns the keys of the conditions that can be evaluated more than once on the same step,
+    not counting again the conditions nested in a condition that is already shared """
+    occurrences = {}
+    def overlapping(key, opcodes):
+        return any(x is None or opcodes is None or x & opcodes for x in occurrences.get(key, []))
+    def count(pattern, where, opcodes, counting):
+        """ Returns whether the pattern can be shared, i.e. it contains no relation and
+        only refers to the source within a where clause """
+        pattern_name = pattern.__class__.__name__
+        if isinstance(pattern, (int, str)) or pattern_name == "Stack":
+            return True
+        if pattern_name in ["Follows", "DataDependency", "ControlDependency"]:
+            count(pattern.source, False, opcodes, counting)
+            count(pattern.destination, False, opcodes, counting)
+            # Where clauses are only evaluated on the opcodes of the destination, and
+            # their equalities are looked up in the source index instead
+            for condition in split_where(pattern.condition)[1]:
+                count(condition, True, intersect_opcodes(opcodes, pattern_opcodes(pattern.destination)[0]), counting)
+            return False
+        if pattern_name == "Source":
+            return count(pattern.property, where, opcodes, counting) and where
+        if pattern_name == "Destination":
+            return count(pattern.property, where, opcodes, counting)
+        if pattern_name == "Memory":
+            return count(pattern.offset, where, opcodes, counting) & count(pattern.size, where, opcodes, counting)
+        key = pattern_key(pattern)
+        nested = counting and not overlapping(key, opcodes)
+        if pattern_name == "In":
+            shareable = count(pattern.element, where, opcodes, nested)
+        else:
+            shareable = count(pattern.x, where, opcodes, nested) & count(pattern.y, where, opcodes, nested)
+        # Opcode atoms are cheaper to evaluate than to look up
+        if counting and shareable and not "opcode" in key:
+            occurrences.setdefault(key, []).append(opcodes)
+        return shareable
+    for pattern in patterns:
+        count(pattern.condition, False, None, True)
+    shared = {}
+    for key in occurrences:
+        for i in range(len(occurrences[key])):
+            x = occurrences[key][i]
+            if any(x is None or y is None or x & y for y in occurrences[key][i+1:]):
+                shared[key] = None
+                break
+    return shared
+
+def requires_taint(model):
+    # Data dependencies are the only relations that rely on taint analysis
+    if "patterns" in dir(model):
+        for pattern in model.patterns:
+            if get_nodes(pattern, "DataDependency"):
+                return True
+    return False
+
+# Opcodes on which the control flow graph reads the input of a call from memory
+CALL_OPCODES = frozenset(["CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"])
+
+def memory_opcodes(model):
+    """ Returns the opcodes on whose steps the analysis of a model reads memory, None meaning any opcode """
+    opcodes = CALL_OPCODES
+    if "patterns" in dir(model):
+        for pattern in model.patterns:
+            matches, effects = pattern_opcodes(pattern.condition)
+            anchors = None if matches is None or effects is None else matches | effects
+            opcodes = unite_opcodes(opcodes, memory_reads(pattern.condition, anchors))
+    return opcodes
+
+def memory_reads(pattern, opcodes, sources=None, destinations=None):
+    """ Returns the opcodes on which evaluating a pattern on the steps of opcodes reads memory, where sources and
+    destinations are the opcodes of the steps src and dst refer to within a where clause, None meaning any opcode """
+    pattern_name = pattern.__class__.__name__
+
+    if not isinstance(pattern, Node):
+        return frozenset()
+
+    if pattern_name == "Memory":
+        return unite_opcodes(opcodes, unite_opcodes(memory_reads(pattern.offset, opcodes, sources, destinations), memory_reads(pattern.size, opcodes, sources, destinations)))
+
+    if pattern_name == "Source":
+        return memory_reads(pattern.property, sources, sources, destinations)
+
+    if pattern_name == "Destination":
+        return memory_reads(pattern.property, destinations, sources, destinations)
+
+    if pattern_name == "BooleanAnd":
+        # The right-hand side is only evaluated where the left-hand side holds
+        x_matches = pattern_opcodes(pattern.x)[0]
+        return unite_opcodes(memory_reads(pattern.x, opcodes, sources, destinations), memory_reads(pattern.y, intersect_opcodes(opcodes, x_matches), sources, destinations))
+
+    if pattern_name in ["Follows", "DataDependency", "ControlDependency"]:
+        reads = unite_opcodes(memory_reads(pattern.source, opcodes, sources, destinations), memory_reads(pattern.destination, opcodes, sources, destinations))
+        if pattern.condition:
+            # Where clauses are evaluated on destinations, and refer to the sources recorded on previous steps
+            relation_sources = intersect_opcodes(opcodes, pattern_opcodes(pattern.source)[0])
+            relation_destinations = intersect_opcodes(opcodes, pattern_opcodes(pattern.destination)[0])
+            reads = unite_opcodes(reads, memory_reads(pattern.condition, relation_destinations, relation_sources, relation_destinations))
+        return reads
+
+    reads = frozenset()
+    for attribute, value in vars(pattern).items():
+        if attribute != "parent":
+            for child in value if isinstance(value, list) else [value]:
+                reads = unite_opcodes(reads, memory_reads(child, opcodes, sources, destinations))
+    return reads
+
 def evaluate_pattern(pattern, trace, step, taint_runner, call_tree, control_flow_graph, dependencies):
     pattern_name = pattern.__class__.__name__
 
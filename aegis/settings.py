@@ -1,3 +1,5 @@
+import os
+
 # HTTP-RPC host
 RPC_HOST = 'localhost'
 # HTTP-RPC port
@@ -6,10 +8,36 @@ RPC_PORT = 8545
 W3 = None
 # Path to patterns file (default 'patterns.rosetta')
 PATTERNS_FILE = 'patterns.rosetta'
+# Number of traces retrieved ahead of the analysis (0 disables prefetching)
+PREFETCH_DEPTH = 4
+# Size in bytes of JSON above which no further traces are retrieved ahead
+PREFETCH_MEMORY = 512 * 1024 * 1024
+# Screen transactions by their call structure before retrieving the full traces of the ones to be analyzed
+SCREEN_TRANSACTIONS = False
+# Retrieve traces with a tracer emitting memory only on the steps the patterns read it
+SHAPE_TRACES = False
+# Time after which Geth stops the JavaScript tracers traces are retrieved with (Geth's default is 5s)
+TRACER_TIMEOUT = '300s'
+# Number of bytes read at once from debug_traceTransaction responses
+TRACE_CHUNK_SIZE = 64 * 1024
+# Number of steps of a trace kept as dicts while they are analyzed
+TRACE_VIEWS = 256
+# Number of processes analyzing bins of independent transactions in parallel
+WORKERS = 1
+# Folder where parsed patterns are cached (empty disables caching)
+PATTERNS_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'aegis', 'patterns')
+# Folder where retrieved traces are cached (empty disables caching)
+TRACE_CACHE = ''
+# Size in bytes of the cached traces above which the least recently read ones are removed
+TRACE_CACHE_SIZE = 1024 * 1024 * 1024
+# Number of taint records kept per call frame (None keeps the full history)
+TAINT_HISTORY = 2
 # Debug mode
 DEBUG_MODE = False
 # Save CFG to a file
 SAVE_CFG = ''
+# Number of Graphviz processes rendering control flow graphs in background
+CFG_RENDER_WORKERS = 2
 # Folder where results should be saved
 RESULTS_FOLDER = ''
 # Etherscan API key token
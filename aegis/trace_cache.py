@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import zlib
+import marshal
+import hashlib
+import threading
+
+import settings
+
+from trace_store import TraceStore
+
+# Version of the encoding of cached traces, files of other versions are not read
+CACHE_VERSION = 3
+
+def cache_header():
+    """ Returns the line cached traces begin with, holding what decoding them depends on: the encoding version, the
+    Python version, whose marshal format may change, and the byte order, typecodes and item sizes of the arrays
+    kept as their bytes """
+    store = TraceStore()
+    arrays = dict(store.columns, fields=store.fields)
+    return json.dumps([CACHE_VERSION, list(sys.version_info[:2]), sys.byteorder, {name: [arrays[name].typecode, arrays[name].itemsize] for name in sorted(arrays)}]).encode()+b"\n"
+
+# Files beginning with another line are not read, and are replaced once their trace is retrieved again
+CACHE_HEADER = cache_header()
+
+class TraceCache:
+    def __init__(self, folder, size, node):
+        """ Keeps the results of debug_traceTransaction requests to a node in a folder, in one file per node,
+        transaction hash and request options, holding the structLogs in the columns of a TraceStore, marshalled
+        and compressed. Files are replaced atomically, so that processes can read them while others write, and
+        once the folder exceeds size bytes the least recently read are removed """
+        self.folder = folder
+        self.size = size
+        # Nodes of different chains may have traced the same transaction hash differently
+        self.node = hashlib.sha256(node.encode()).hexdigest()[:16]
+        # Bytes in the folder when it was last scanned, and bytes written since
+        self.total = None
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def path(self, transaction_hash, options):
+        transaction_hash = transaction_hash.lower()
+        variant = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.folder, transaction_hash[-2:], transaction_hash+"."+self.node+"."+variant+".trace")
+
+    def get(self, transaction_hash, options):
+        """ Returns the cached result of a request, or None if it is not cached """
+        return self.read(self.path(transaction_hash, options))[1]
+
+    def results(self, transaction_hash):
+        """ Returns the options and result of every cached request for a transaction """
+        transaction_hash = transaction_hash.lower()
+        try:
+            names = os.listdir(os.path.join(self.folder, transaction_hash[-2:]))
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(transaction_hash+"."+self.node+".") and name.endswith(".trace"):
+                options, result = self.read(os.path.join(self.folder, transaction_hash[-2:], name))
+                if result is not None:
+                    yield options, result
+
+    def read(self, path):
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            # The modification time orders files by their last read, as access times are often not kept
+            os.utime(path)
+            if not data.startswith(CACHE_HEADER):
+                return None, None
+            options, result, columns = marshal.loads(zlib.decompress(data[len(CACHE_HEADER):]))
+            if columns is not None:
+                store = TraceStore()
+                for column in store.columns:
+                    store.columns[column].frombytes(columns["columns"][column])
+                store.fields.frombytes(columns["fields"])
+                store.opcodes, store.words, store.extras = columns["opcodes"], columns["words"], columns["extras"]
+                store.transaction_rows.append(0)
+                store.transactions.append(None)
+                result["structLogs"] = read_struct_logs(store)
+        except Exception:
+            return None, None
+        return options, result
+
+    def put(self, transaction_hash, options, result, store=None):
+        """ Caches the result of a request, whose structLogs are already appended to store if one is given """
+        if store is None and isinstance(result.get("structLogs"), list):
+            store = TraceStore()
+            for struct_log in result["structLogs"]:
+                store.append_row(struct_log)
+        columns = None
+        if store is not None:
+            # Arrays are kept as their bytes, which are only read back with the same header
+            columns = {"columns": {column: store.columns[column].tobytes() for column in store.columns}, "fields": store.fields.tobytes(), "opcodes": store.opcodes, "words": store.words, "extras": store.extras}
+        path = self.path(transaction_hash, options)
+        try:
+            data = CACHE_HEADER+zlib.compress(marshal.dumps((options, {key: result[key] for key in result if key != "structLogs"}, columns)))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = path+"."+str(os.getpid())+"."+str(threading.get_ident())
+            with open(temporary, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+        except Exception as e:
+            if settings.DEBUG_MODE:
+                print("Could not cache trace "+str(transaction_hash)+": "+str(e))
+            return
+        with self.lock:
+            self.written += len(data)
+            if self.total is None or self.total + self.written > self.size:
+                self.evict()
+
+    def evict(self):
+        """ Removes the least recently read files until the folder holds at most nine tenths of its size, so
+        that it is not scanned again on every write """
+        files = []
+        try:
+            for directory in os.scandir(self.folder):
+                if directory.is_dir():
+                    for entry in os.scandir(directory.path):
+                        if entry.name.endswith(".trace"):
+                            stat = entry.stat()
+                            files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            pass
+        total = sum(size for _, size, _ in files)
+        if total > self.size:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self.total, self.written = total, 0
+
+class TraceRecorder(TraceStore):
+    def __init__(self, cache, transaction_hash, options, result):
+        """ Encodes the structLog entries of a response as they are read, and caches them along with the
+        rest of its result once all of them are read """
+        super().__init__()
+        self.cache = cache
+        self.transaction_hash = transaction_hash
+        self.options = options
+        self.result = result
+
+    def close(self):
+        self.cache.put(self.transaction_hash, self.options, self.result, self)
+
+def read_struct_logs(store):
+    """ Returns the structLog entries of a decoded trace, one at a time """
+    for row in range(len(store.fields)):
+        struct_log = store.get_values(row)
+        del struct_log["transaction"]
+        yield struct_log
+
+trace_caches = {}
+trace_caches_lock = threading.Lock()
+
+def get_trace_cache():
+    """ Returns the trace cache of the settings, or None if traces are not cached """
+    if not settings.TRACE_CACHE:
+        return None
+    # Processes forked from one another do not share a cache, as its lock may be held at the time of the fork
+    key = (settings.TRACE_CACHE, settings.TRACE_CACHE_SIZE, settings.RPC_HOST, settings.RPC_PORT, os.getpid())
+    with trace_caches_lock:
+        if not key in trace_caches:
+            trace_caches[key] = TraceCache(settings.TRACE_CACHE, settings.TRACE_CACHE_SIZE, settings.RPC_HOST+":"+str(settings.RPC_PORT))
+        return trace_caches[key]
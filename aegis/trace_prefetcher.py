@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import settings
+
+from utils import request_debug_trace, StructLogStream
+
+class TracePrefetcher:
+    def __init__(self, connection, transactions, depth=None, memory=None, tracer=None):
+        """ Retrieves the traces of transactions in background threads, in the order they are analyzed.
+        At most depth traces are retrieved ahead, and no further retrieval starts while the
+        retrieved traces waiting to be analyzed exceed memory bytes of JSON. A trace that is to be
+        analyzed before its retrieval started, such as the first one, is streamed into the analysis.
+        Traces are retrieved with tracer if one is given, and with the default tracer otherwise """
+        self.connection = connection
+        self.transactions = transactions
+        self.tracer = tracer
+        self.depth = settings.PREFETCH_DEPTH if depth is None else depth
+        self.memory = settings.PREFETCH_MEMORY if memory is None else memory
+        self.responses = {}
+        self.retrieved = 0
+        self.analyzed = 0
+        self.pending_memory = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.retrieve, daemon=True) for _ in range(self.depth)]
+        for thread in self.threads:
+            thread.start()
+
+    def can_retrieve(self):
+        if self.closed or self.retrieved >= len(self.transactions):
+            return True
+        # Retrieval ahead starts along with the analysis of the first trace
+        if self.analyzed == 0 or self.retrieved - self.analyzed >= self.depth:
+            return False
+        return self.pending_memory < self.memory
+
+    def retrieve(self):
+        import http.client
+        connection = http.client.HTTPConnection(settings.RPC_HOST, settings.RPC_PORT)
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(self.can_retrieve)
+                    if self.closed or self.retrieved >= len(self.transactions):
+                        return
+                    index = self.retrieved
+                    self.retrieved += 1
+                size = 0
+                try:
+                    response = request_debug_trace(connection, self.transactions[index]["hash"], stream=True, tracer=self.tracer)
+                    if isinstance(response.get("result"), dict) and isinstance(response["result"].get("structLogs"), StructLogStream):
+                        struct_logs = response["result"]["structLogs"]
+                        response["result"]["structLogs"] = list(struct_logs)
+                        size = struct_logs.size
+                except Exception as e:
+                    response = {"error": e}
+                with self.condition:
+                    self.responses[index] = (response, size)
+                    self.pending_memory += size
+                    self.condition.notify_all()
+        finally:
+            connection.close()
+
+    def get(self, transaction):
+        """ Returns the debug_traceTransaction response of the next transaction to be analyzed, whose
+        structLogs are still being read from the connection if its retrieval had not started """
+        if not self.depth:
+            return request_debug_trace(self.connection, transaction["hash"], stream=True, tracer=self.tracer)
+        with self.condition:
+            if self.transactions[self.analyzed]["hash"] != transaction["hash"]:
+                raise Exception("Transaction "+transaction["hash"]+" requested out of order, expected "+self.transactions[self.analyzed]["hash"])
+            streamed = self.retrieved == self.analyzed
+            if streamed:
+                self.retrieved += 1
+            else:
+                self.condition.wait_for(lambda: self.analyzed in self.responses)
+                response, size = self.responses.pop(self.analyzed)
+                self.pending_memory -= size
+            self.analyzed += 1
+            self.condition.notify_all()
+        if streamed:
+            return request_debug_trace(self.connection, transaction["hash"], stream=True, tracer=self.tracer)
+        return response
+
+    def close(self):
+        """ Stops retrieving traces, each thread closing its connection once its current request is done """
+        with self.condition:
+            self.closed = True
+            self.responses = {}
+            self.pending_memory = 0
+            self.condition.notify_all()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import itertools
+import collections
+
+from array import array
+
+import settings
+
+# Keys of a structLog entry kept in typed columns, with their bit in the fields column
+COLUMNS = {"pc": 1, "op": 2, "gas": 4, "gasCost": 8, "depth": 16, "stack": 32, "memory": 64}
+INTEGER_COLUMNS = {"pc": "Q", "gas": "Q", "gasCost": "Q", "depth": "H"}
+WORD_COLUMNS = ["stack", "memory"]
+ALL_FIELDS = sum(COLUMNS.values())
+
+class TraceStore(dict):
+    def __init__(self):
+        """ Holds the steps of a trace in columns: pc, gas, gasCost, depth and opcode ids in typed arrays, the
+        words of stack and memory as ids into one table of distinct words, and transactions as runs of rows.
+        Steps are looked up by number like in a dict of structLog entries, and read as new dicts, the latest
+        of which are kept as the entries of this dict. These are views: changing them changes no step """
+        self.columns = {column: array(INTEGER_COLUMNS[column]) for column in INTEGER_COLUMNS}
+        self.columns["op"] = array("H")
+        self.fields = array("B")
+        for column in WORD_COLUMNS:
+            self.columns[column] = array("I")
+            # Beginning and end of the words of each row, rows with the same words share them
+            self.columns[column+"_spans"] = array("Q")
+        self.opcodes, self.opcode_ids = [], {}
+        # Words are given the next id on first lookup
+        self.words, self.word_ids = [], collections.defaultdict(itertools.count().__next__)
+        self.last_memory = None
+        # Words of the memory read last, which steps that do not change the memory share
+        self.memory_span, self.memory_words = None, None
+        # Keys without a column, and values that do not fit in theirs
+        self.extras = {}
+        self.transaction_rows, self.transactions = array("Q"), []
+        # Steps kept from previous transactions, and the range of steps appended last
+        self.retained = {}
+        self.begin, self.end, self.offset = 0, 0, 0
+        # Entries of the steps appended last that were not read yet
+        self.source = None
+
+    def __len__(self):
+        self.read()
+        return len(self.retained) + self.end - self.begin
+
+    def __contains__(self, step):
+        if step >= self.end and self.source is not None:
+            self.read(step)
+        return self.begin <= step < self.end or step in self.retained
+
+    def __iter__(self):
+        self.read()
+        return iter(sorted(self.retained) + list(range(self.begin, self.end)))
+
+    def __missing__(self, step):
+        if step >= self.end and self.source is not None:
+            self.read(step)
+        if self.begin <= step < self.end:
+            row = self.offset + step - self.begin
+        elif step in self.retained:
+            row = self.retained[step]
+        else:
+            raise KeyError(step)
+        # Analyses mostly read recent steps and the sources of relations, so only the latest views are kept
+        if dict.__len__(self) >= settings.TRACE_VIEWS:
+            del self[next(dict.__iter__(self))]
+        view = self[step] = self.get_values(row)
+        return view
+
+    def members(self):
+        """ Returns the objects holding the steps, which views are built from """
+        return (self.columns, self.fields, self.opcodes, self.opcode_ids, self.words, self.word_ids, self.last_memory, self.memory_words, self.extras, self.transaction_rows, self.transactions, self.retained)
+
+    def append(self, step, struct_logs, transaction):
+        """ Appends the structLog entries of a transaction as the steps following step. Entries are read from
+        struct_logs as the steps are looked up, so that the analysis can start while they are retrieved """
+        self.read()
+        if self.begin < self.end and step != self.end:
+            for s in range(self.begin, self.end):
+                self.retained[s] = self.offset + s - self.begin
+            self.begin = self.end
+        if self.begin == self.end:
+            self.begin, self.end, self.offset = step, step, len(self.fields)
+        self.transaction_rows.append(len(self.fields))
+        self.transactions.append(transaction)
+        self.source = iter(struct_logs)
+
+    def read(self, step=None):
+        """ Reads entries until step is appended, or all of them """
+        if self.source is None:
+            return
+        for struct_log in self.source:
+            self.append_row(struct_log)
+            self.end += 1
+            if step is not None and step < self.end:
+                return
+        self.source = None
+
+    def append_row(self, struct_log):
+        row, fields, extras = len(self.fields), 0, {}
+        for column in COLUMNS:
+            value = struct_log.get(column)
+            if column in INTEGER_COLUMNS:
+                try:
+                    self.columns[column].append(value)
+                    fields |= COLUMNS[column]
+                    continue
+                except (OverflowError, TypeError):
+                    self.columns[column].append(0)
+            elif column == "op":
+                if isinstance(value, str):
+                    if not value in self.opcode_ids:
+                        self.opcode_ids[value] = len(self.opcodes)
+                        self.opcodes.append(value)
+                    self.columns["op"].append(self.opcode_ids[value])
+                    fields |= COLUMNS[column]
+                    continue
+                self.columns["op"].append(0)
+            elif isinstance(value, list) and self.append_words(column, value):
+                fields |= COLUMNS[column]
+                continue
+            else:
+                self.columns[column+"_spans"].extend([0, 0])
+                if column == "memory":
+                    self.last_memory = None
+            if column in struct_log:
+                extras[column] = value
+        for key in struct_log:
+            # Entries saved by earlier versions refer to their transaction, which is kept as a run instead
+            if not key in COLUMNS and key != "transaction":
+                extras[key] = struct_log[key]
+        self.fields.append(fields)
+        if extras:
+            self.extras[row] = extras
+
+    def append_words(self, column, words):
+        """ Appends the ids of words to a column, returns False if they cannot be kept in it """
+        ids, spans = self.columns[column], self.columns[column+"_spans"]
+        # Memory mostly stays the same from one step to the next
+        if column == "memory" and spans and self.last_memory == words:
+            spans.extend(spans[-2:])
+            return True
+        begin, word_ids = len(ids), self.word_ids
+        try:
+            ids.extend(map(word_ids.__getitem__, words))
+        except TypeError:
+            del ids[begin:]
+            # Keeps the table in line with the words given an id before the unhashable one
+            self.words.extend(list(word_ids)[len(self.words):])
+            return False
+        if len(word_ids) > len(self.words):
+            for word in words:
+                if word_ids[word] == len(self.words):
+                    self.words.append(word)
+        spans.extend([begin, len(ids)])
+        if column == "memory":
+            self.last_memory = words
+        return True
+
+    def retain(self, steps):
+        """ Removes every step that is not in steps """
+        self.read()
+        kept = TraceStore()
+        for step in sorted(step for step in steps if step in self):
+            kept.retained[step] = len(kept.fields)
+            view = self[step]
+            if not kept.transactions or not kept.transactions[-1] is view["transaction"]:
+                kept.transaction_rows.append(len(kept.fields))
+                kept.transactions.append(view["transaction"])
+            kept.append_row({key: view[key] for key in view.keys() if key != "transaction"})
+        dict.clear(self)
+        self.__dict__ = kept.__dict__
+
+    def get_values(self, row):
+        """ Returns the structLog entry of a step, with the transaction it belongs to """
+        columns, words = self.columns, self.words
+        fields = self.fields[row]
+        # Traces retrieved with a tracer only have memory on some steps
+        if fields | COLUMNS["memory"] == ALL_FIELDS:
+            spans = columns["stack_spans"]
+            values = {
+                "pc": columns["pc"][row],
+                "op": self.opcodes[columns["op"][row]],
+                "gas": columns["gas"][row],
+                "gasCost": columns["gasCost"][row],
+                "depth": columns["depth"][row],
+                "stack": list(map(words.__getitem__, columns["stack"][spans[2*row]:spans[2*row+1]]))
+            }
+            if fields & COLUMNS["memory"]:
+                memory_spans = columns["memory_spans"]
+                memory_span = (memory_spans[2*row], memory_spans[2*row+1])
+                if memory_span != self.memory_span:
+                    self.memory_span, self.memory_words = memory_span, list(map(words.__getitem__, columns["memory"][memory_span[0]:memory_span[1]]))
+                values["memory"] = self.memory_words
+        else:
+            values = {column: self.get_value(row, column) for column in COLUMNS if fields & COLUMNS[column]}
+        values["transaction"] = self.transactions[bisect.bisect_right(self.transaction_rows, row) - 1]
+        if row in self.extras:
+            values.update(self.extras[row])
+        return values
+
+    def get_value(self, row, key):
+        """ Returns the value of a step kept in a column or among its extras """
+        if self.fields[row] & COLUMNS.get(key, 0):
+            if key == "op":
+                return self.opcodes[self.columns["op"][row]]
+            if key in INTEGER_COLUMNS:
+                return self.columns[key][row]
+            spans = self.columns[key+"_spans"]
+            return list(map(self.words.__getitem__, self.columns[key][spans[2*row]:spans[2*row+1]]))
+        extras = self.extras.get(row)
+        if extras and key in extras:
+            return extras[key]
+        raise KeyError(key)
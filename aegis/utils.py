@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import http
 import json
 import time
+import codecs
 import random
-import eth_utils
+import decimal
 import settings
 
-from collections import Mapping, Container
+from collections.abc import Mapping, Container
 from sys import getsizeof
+from array import array
+from trace_store import TraceStore
+from trace_cache import get_trace_cache, TraceRecorder
 
 def serialize_web3_object(object):
     if object.__class__.__name__ == "str":
@@ -51,8 +56,66 @@ def is_block_within_ranges(block, ranges):
     return False
 
 def normalize_32_byte_hex_address(value):
-    as_bytes = eth_utils.to_bytes(hexstr=value)
-    return eth_utils.to_normalized_address(as_bytes[-20:])
+    value = value[2:] if value.startswith(("0x", "0X")) else value
+    # Validates the value the same way eth_utils.to_bytes does, without importing eth_utils
+    as_bytes = bytes.fromhex(value if len(value) % 2 == 0 else "0"+value)
+    if len(as_bytes) < 20:
+        raise ValueError("Unknown format "+repr(as_bytes)+", expected at least 20 bytes")
+    return "0x"+as_bytes[-20:].hex()
+
+def read_memory(memory, offset, size):
+    """ Returns size hex digits of the memory of a structLog entry from offset, joining only the words of
+    64 hex digits they are part of """
+    first = offset // 64
+    return ''.join(memory[first:(offset + size + 63) // 64])[offset - first * 64:offset - first * 64 + size]
+
+def convert_wei_to_ether(value):
+    """ Returns an amount of wei in ether, as Web3.fromWei does """
+    if value == 0:
+        return 0
+    with decimal.localcontext() as context:
+        context.prec = 999
+        return decimal.Decimal(value) / decimal.Decimal(10**18)
+
+def add_bin_candidate(candidates, bin, key):
+    """ Records that a bin holds a transaction with the given key, keeping the lowest bin index of the
+    two lowest keys, which is all that is needed to find the lowest bin holding a different key """
+    if not candidates:
+        candidates.extend([bin, key, None, None])
+    elif key == candidates[1]:
+        candidates[0] = min(candidates[0], bin)
+    elif bin < candidates[0]:
+        candidates[2:4] = candidates[0:2]
+        candidates[0:2] = [bin, key]
+    elif candidates[2] is None or bin < candidates[2]:
+        candidates[2:4] = [bin, key]
+
+def get_bin_candidate(candidates, key):
+    """ Returns the lowest bin holding a transaction with a key different from the given one """
+    if not candidates:
+        return None
+    if candidates[1] != key:
+        return candidates[0]
+    return candidates[2]
+
+def bin_transactions(transactions):
+    """ Returns the transactions grouped in bins, adding each transaction to the first bin holding either a
+    transaction of the same block from another sender, or a transaction of the same sender with another input """
+    bins = []
+    senders_by_block, inputs_by_sender = {}, {}
+    for transaction in transactions:
+        block_candidates = senders_by_block.setdefault(transaction["blockNumber"], [])
+        sender_candidates = inputs_by_sender.setdefault(transaction["from"], [])
+        found = [i for i in [get_bin_candidate(block_candidates, transaction["from"]), get_bin_candidate(sender_candidates, transaction["input"])] if i is not None]
+        if found:
+            i = min(found)
+            bins[i].append(transaction)
+        else:
+            i = len(bins)
+            bins.append([transaction])
+        add_bin_candidate(block_candidates, i, transaction["from"])
+        add_bin_candidate(sender_candidates, i, transaction["input"])
+    return bins
 
 def convert_hex_to_int(x):
     if isinstance(x, str) and x.startswith("0x"):
@@ -67,9 +130,35 @@ def convert_hex_to_int(x):
         return new_list
     return x
 
-def request_debug_trace(connection, transaction_hash, disable_stack=False, disable_memory=False, disable_storage=True, retries=0):
+def request_debug_trace(connection, transaction_hash, disable_stack=False, disable_memory=False, disable_storage=True, retries=0, stream=False, tracer=None):
+    options = {"disableStack": disable_stack, "disableMemory": disable_memory, "disableStorage": disable_storage}
+    if tracer:
+        options["tracer"] = tracer
+    cache = get_trace_cache()
+    if cache:
+        result = read_cached_trace(cache, transaction_hash, options)
+        if result is not None:
+            return {"id": 1, "result": result}
+    # The timeout is left out of the options traces are cached with, as it does not change the trace
+    data = json.dumps({"id": 1, "method": "debug_traceTransaction", "params": [transaction_hash, dict(options, timeout=settings.TRACER_TIMEOUT) if tracer else options]})
+    trace = post_debug_trace(connection, transaction_hash, data, stream)
+    if tracer and tracer != CALL_STRUCTURE_TRACER and isinstance(trace.get("error"), dict):
+        print("Retrieving trace "+str(transaction_hash)+" with the structLog tracer failed, retrieving it with the default tracer instead: "+str(trace["error"]))
+        return request_debug_trace(connection, transaction_hash, disable_stack, disable_memory, disable_storage, retries, stream)
+    if isinstance(trace.get("result"), dict) and isinstance(trace["result"].get("structLogs"), StructLogStream):
+        def resume():
+            # The connection is left in an unknown state by the response that dropped
+            connection.close()
+            return post_debug_trace(connection, transaction_hash, data, True)
+        trace["result"]["structLogs"].resume = resume
+        if cache:
+            trace["result"]["structLogs"].recorder = TraceRecorder(cache, transaction_hash, options, trace["result"])
+    elif cache and isinstance(trace.get("result"), dict):
+        cache.put(transaction_hash, options, trace["result"])
+    return trace
+
+def post_debug_trace(connection, transaction_hash, data, stream):
     headers = {"Content-Type": "application/json"}
-    data = json.dumps({"id": 1, "method": "debug_traceTransaction", "params": [transaction_hash, {"disableStack": disable_stack, "disableMemory": disable_memory, "disableStorage": disable_storage}]})
     tries = 0
     while tries < 10:
         try:
@@ -77,8 +166,7 @@ def request_debug_trace(connection, transaction_hash, disable_stack=False, disab
             connection.request('GET', '/', data, headers)
             response = connection.getresponse()
             if response.status == 200 and response.reason == "OK":
-                data = response.read().decode()
-                return json.loads(data)
+                return read_debug_trace(response) if stream else json.loads(response.read().decode())
             return {"error": {"status": response.status, "reason": response.reason, "data": response.read().decode()}}
         except Exception as e:
             if str(e) == "Remote end closed connection without response":
@@ -93,6 +181,270 @@ def request_debug_trace(connection, transaction_hash, disable_stack=False, disab
             else:
                 return {"error": e}
 
+# JavaScript tracer emitting the structLogs of the default tracer, with memory only on the steps of some opcodes
+STRUCT_LOG_TRACER = """{
+    memoryOpcodes: %s,
+    structLogs: [],
+    word: function(value) {
+        var hex = value.toString(16);
+        return "0000000000000000000000000000000000000000000000000000000000000000".slice(hex.length) + hex;
+    },
+    step: function(log, db) {
+        var structLog = {pc: log.getPC(), op: log.op.toString(), gas: log.getGas(), gasCost: log.getCost(), depth: log.getDepth(), stack: []};
+        for (var i = log.stack.length() - 1; i >= 0; i--) {
+            structLog.stack.push(this.word(log.stack.peek(i)));
+        }
+        if (this.memoryOpcodes[structLog.op]) {
+            var memory = toHex(log.memory.slice(0, log.memory.length())).slice(2);
+            structLog.memory = [];
+            for (var j = 0; j < memory.length; j += 64) {
+                structLog.memory.push(memory.slice(j, j + 64));
+            }
+        }
+        if (log.getError()) {
+            structLog.error = "" + log.getError();
+        }
+        this.structLogs.push(structLog);
+    },
+    fault: function(log, db) {
+        var last = this.structLogs[this.structLogs.length - 1];
+        if (!last || last.pc != log.getPC() || last.depth != log.getDepth() || last.error) {
+            this.step(log, db);
+            last = this.structLogs[this.structLogs.length - 1];
+        }
+        last.error = "" + log.getError();
+    },
+    result: function(ctx, db) {
+        return {gas: ctx.gasUsed, failed: ctx.error !== undefined, returnValue: toHex(ctx.output).slice(2), structLogs: this.structLogs};
+    }
+}"""
+
+def struct_log_tracer(memory_opcodes):
+    """ Returns the tracer retrieving structLogs with memory only on the steps of memory_opcodes, or None
+    if memory is needed on every step, in which case traces are retrieved with the default tracer """
+    if memory_opcodes is None:
+        return None
+    return STRUCT_LOG_TRACER % json.dumps({opcode: True for opcode in sorted(memory_opcodes)})
+
+# JavaScript tracer emitting the opcodes a transaction executes, and the depth and address of each call frame it enters
+CALL_STRUCTURE_TRACER = """{
+    opcodes: {},
+    frames: [],
+    call: null,
+    creates: [],
+    address: function(value) {
+        return "0x" + ("0000000000000000000000000000000000000000" + value.toString(16)).slice(-40);
+    },
+    step: function(log, db) {
+        var op = log.op.toString(), depth = log.getDepth();
+        this.opcodes[op] = true;
+        if (this.call !== null) {
+            if (depth > this.call.depth) {
+                var frame = [depth, this.call.address];
+                this.frames.push(frame);
+                if (frame[1] === null) {
+                    this.creates.push([this.call.depth, frame]);
+                }
+            }
+            this.call = null;
+        }
+        // Created contracts are known once their address is pushed on the stack of the creating frame
+        while (this.creates.length > 0 && this.creates[this.creates.length - 1][0] >= depth) {
+            this.creates.pop()[1][1] = this.address(log.stack.peek(0));
+        }
+        if (op == "CALL" || op == "CALLCODE" || op == "DELEGATECALL" || op == "STATICCALL") {
+            this.call = {depth: depth, address: this.address(log.stack.peek(1))};
+        } else if (op == "CREATE" || op == "CREATE2") {
+            this.call = {depth: depth, address: null};
+        }
+    },
+    fault: function(log, db) {
+    },
+    result: function(ctx, db) {
+        return {opcodes: Object.keys(this.opcodes), frames: this.frames};
+    }
+}"""
+
+def summarize_call_structure(result, address):
+    """ Returns the opcodes a transaction executes and whether it enters a call frame running the code of an address
+    already on the call stack, given the result of CALL_STRUCTURE_TRACER and the address of the first call frame """
+    stack, reentrant = [address.lower()], False
+    for depth, frame_address in result["frames"]:
+        del stack[depth - 1:]
+        # Contracts whose creation did not return are assumed to be any address
+        if frame_address is None or frame_address.lower() in stack:
+            reentrant = True
+            break
+        stack.append(frame_address.lower())
+    return {"opcodes": frozenset(result["opcodes"]), "reentrant": reentrant}
+
+def call_structure(struct_logs):
+    """ Returns what CALL_STRUCTURE_TRACER returns for a transaction, given its structLogs """
+    opcodes, frames, call, creates = {}, [], None, []
+    for struct_log in struct_logs:
+        op, depth = struct_log["op"], struct_log["depth"]
+        opcodes[op] = True
+        if call is not None:
+            if depth > call[0]:
+                frames.append([depth, call[1]])
+                if call[1] is None:
+                    creates.append((call[0], frames[-1]))
+            call = None
+        while creates and creates[-1][0] >= depth:
+            creates.pop()[1][1] = "0x%040x" % (int(struct_log["stack"][-1], 16) % 2**160)
+        if op in ["CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"]:
+            call = (depth, "0x%040x" % (int(struct_log["stack"][-2], 16) % 2**160))
+        elif op in ["CREATE", "CREATE2"]:
+            call = (depth, None)
+    return {"opcodes": list(opcodes), "frames": frames}
+
+# Options of debug_traceTransaction requests retrieving full structLogs with the default tracer
+FULL_TRACE_OPTIONS = {"disableStack": False, "disableMemory": False, "disableStorage": True}
+
+def read_cached_trace(cache, transaction_hash, options):
+    """ Returns the cached result of a debug_traceTransaction request, or one derived from a cached trace
+    holding everything the request retrieves, or None """
+    result = cache.get(transaction_hash, options)
+    if result is None and options.get("tracer") == CALL_STRUCTURE_TRACER:
+        for cached_options, cached in cache.results(transaction_hash):
+            # Every structLog entry has the opcode, depth and stack the call structure is made of
+            if "structLogs" in cached and not cached_options.get("disableStack"):
+                return call_structure(cached["structLogs"])
+    elif result is None and options.get("tracer", "").startswith(STRUCT_LOG_TRACER[:STRUCT_LOG_TRACER.index("%s")]):
+        # Memory on every step holds the memory of the steps the tracer emits it on
+        result = cache.get(transaction_hash, FULL_TRACE_OPTIONS)
+    return result
+
+STRUCT_LOGS = re.compile(r'"structLogs"\s*:\s*\[')
+SEPARATORS = re.compile(r'[\s,]*')
+DECODER = json.JSONDecoder()
+
+def read_debug_trace(response):
+    """ Returns a debug_traceTransaction response read up to its structLogs, which are then read by iterating over them """
+    decoder, text, size, match = codecs.getincrementaldecoder("utf-8")(), "", 0, None
+    while not match:
+        chunk = response.read(settings.TRACE_CHUNK_SIZE)
+        if not chunk:
+            return json.loads(text + decoder.decode(b"", True))
+        size += len(chunk)
+        searched = len(text)
+        text += decoder.decode(chunk)
+        # The key may be split across chunks, so the end of the previous chunk is searched again
+        match = STRUCT_LOGS.search(text, max(0, searched - 64))
+    prefix = text[:match.start()]
+    trace = json.loads(prefix + '"structLogs": []' + closing_brackets(prefix))
+    if "result" in trace:
+        trace["result"]["structLogs"] = StructLogStream(response, decoder, text[match.end():], size)
+    return trace
+
+def closing_brackets(text):
+    """ Returns the brackets that close the objects and arrays left open at the end of a JSON text """
+    brackets, in_string, escaped = [], False, False
+    for character in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif character == "\\":
+                escaped = True
+            elif character == '"':
+                in_string = False
+        elif character == '"':
+            in_string = True
+        elif character in "{[":
+            brackets.append("}" if character == "{" else "]")
+        elif character in "}]":
+            brackets.pop()
+    return "".join(reversed(brackets))
+
+class StructLogStream:
+    def __init__(self, response, decoder, text, size):
+        """ Iterates over the structLogs of a debug_traceTransaction response as they are read from the connection,
+        holding one chunk of the response at a time. size is the number of bytes of the response read so far """
+        self.response = response
+        self.decoder = decoder
+        self.text = text
+        self.position = 0
+        self.size = size
+        self.done = False
+        # Encodes the entries read for the trace cache, if any
+        self.recorder = None
+        # Requests the response again if the connection drops before its end, the entries read so far being skipped
+        self.resume = None
+        self.count = 0
+        # Seconds spent waiting for the connection
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def read(self, size):
+        begin = time.time()
+        try:
+            chunk = self.response.read(size)
+        except Exception as e:
+            chunk, error = None, e
+        else:
+            error = ValueError("Incomplete structLogs in the response")
+        if not chunk:
+            self.reopen(error)
+        else:
+            self.size += len(chunk)
+            self.text = self.text[self.position:] + self.decoder.decode(chunk)
+            self.position = 0
+        self.elapsed += time.time() - begin
+
+    def reopen(self, error):
+        """ Requests the response again after the connection dropped, and reads it up to the entry to be read next """
+        self.response.close()
+        tries = 0
+        while self.resume is not None and tries < 10:
+            tries += 1
+            print("Connection dropped while reading structLogs ("+str(error)+"), requesting them again.")
+            trace = self.resume()
+            if "error" in trace:
+                error = trace["error"]
+                continue
+            stream = trace["result"].get("structLogs") if isinstance(trace.get("result"), dict) else None
+            if not isinstance(stream, StructLogStream):
+                error = ValueError("No structLogs in the response")
+                continue
+            try:
+                for _ in range(self.count):
+                    next(stream)
+            except Exception as e:
+                stream.response.close()
+                error = e
+                continue
+            self.response, self.decoder, self.text, self.position, self.size = stream.response, stream.decoder, stream.text, stream.position, stream.size
+            return
+        raise error
+
+    def __next__(self):
+        while not self.done:
+            self.position = SEPARATORS.match(self.text, self.position).end()
+            if self.position == len(self.text):
+                self.read(settings.TRACE_CHUNK_SIZE)
+            elif self.text[self.position] == "]":
+                # Reads the rest of the response, so that the connection can be reused
+                try:
+                    self.size += len(self.response.read())
+                except Exception:
+                    self.response.close()
+                self.text, self.done = "", True
+                if self.recorder is not None:
+                    self.recorder.close()
+            else:
+                try:
+                    struct_log, self.position = DECODER.raw_decode(self.text, self.position)
+                    self.count += 1
+                    if self.recorder is not None:
+                        self.recorder.append_row(struct_log)
+                    return struct_log
+                except json.JSONDecodeError:
+                    # Reads at least as much as is buffered, so that large entries are not parsed again too often
+                    self.read(max(settings.TRACE_CHUNK_SIZE, len(self.text) - self.position))
+        raise StopIteration
+
 def deep_getsizeof(o, ids):
     """Find the memory footprint of a Python object
     This is a recursive function that rills down a Python object graph
@@ -112,9 +464,14 @@ def deep_getsizeof(o, ids):
     r = getsizeof(o)
     ids.add(id(o))
 
-    if isinstance(o, str):
+    # Strings and typed arrays hold their values inline
+    if isinstance(o, (str, bytes, array)):
         return r
 
+    # Trace stores are measured by the objects holding their steps, along with the views they keep
+    if isinstance(o, TraceStore):
+        return r + sum(d(x, ids) for x in o.members()) + sum(d(k, ids) + d(v, ids) for k, v in dict.items(o))
+
     if isinstance(o, Mapping):
         return r + sum(d(k, ids) + d(v, ids) for k, v in o.items())
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import random
+import argparse
+
+AEGIS_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis')
+sys.path.insert(0, AEGIS_FOLDER)
+
+from utils import bin_transactions
+
+def bin_transactions_pairwise(transactions):
+    """ Returns the transactions grouped in bins, comparing each transaction against every binned one, as done before bins were indexed """
+    bins = []
+    for transaction in transactions:
+        found = False
+        for i in range(len(bins)):
+            for j in range(len(bins[i])):
+                if bins[i][j]["blockNumber"] == transaction["blockNumber"] and bins[i][j]["from"] != transaction["from"]:
+                    bins[i].append(transaction)
+                    found = True
+                    break
+                if bins[i][j]["from"] == transaction["from"] and bins[i][j]["input"] != transaction["input"]:
+                    bins[i].append(transaction)
+                    found = True
+                    break
+            if found:
+                break
+        if not found:
+            bins.append([transaction])
+    return bins
+
+def generate_transactions(count, seed):
+    """ Returns a synthetic transaction list of a contract, with a few transactions per block and mostly recurring senders and inputs """
+    generator = random.Random(seed)
+    senders = ["0x%040x" % i for i in range(max(1, count // 10))]
+    inputs = ["0x%08x" % i for i in range(16)]
+    transactions, block_number = [], 10000000
+    while len(transactions) < count:
+        block_number += generator.randint(1, 20)
+        for _ in range(min(generator.randint(1, 3), count - len(transactions))):
+            transactions.append({
+                "hash": "0x%064x" % len(transactions),
+                "blockNumber": block_number,
+                "from": generator.choice(senders),
+                "input": generator.choice(inputs)
+            })
+    return transactions
+
+def measure(function, transactions):
+    begin = time.perf_counter()
+    bins = function(transactions)
+    return time.perf_counter() - begin, bins
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the indexed binning of transactions against the pairwise binning on synthetic transaction lists.")
+    parser.add_argument(
+        "-s", "--sizes", type=str, default="10000,100000,1000000", help="comma-separated numbers of transactions (default: 10000,100000,1000000)")
+    parser.add_argument(
+        "--pairwise-limit", type=int, default=10000, help="number of transactions above which the pairwise binning is not measured (default: 10000)")
+    parser.add_argument(
+        "--seed", type=int, default=1, help="seed of the synthetic transaction lists (default: 1)")
+    args = parser.parse_args()
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        transactions = generate_transactions(size, args.seed)
+        indexed, bins = measure(bin_transactions, transactions)
+        print("Transactions: \t\t %d (%d bins)" % (size, len(bins)))
+        print("Indexed binning: \t %.3f second(s)" % indexed)
+        if size <= args.pairwise_limit:
+            pairwise, pairwise_bins = measure(bin_transactions_pairwise, transactions)
+            if bins != pairwise_bins:
+                print("Warning: the indexed and the pairwise binning differ.")
+            print("Pairwise binning: \t %.3f second(s)" % pairwise)
+            print("Speedup: \t\t %.0fx" % (pairwise / indexed))
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+
+AEGIS_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis')
+sys.path.insert(0, AEGIS_FOLDER)
+
+import settings
+
+from rosetta import *
+from dynamic_call_tree import *
+from control_flow_graph import *
+from dynamic_taint_analysis import *
+
+def interpret(pattern, context, step):
+    """ Evaluates a pattern by walking its textX model, as done before patterns were compiled """
+    return evaluate_pattern(pattern.condition, context.trace, step, context.taint_runner, context.call_tree, context.control_flow_graph, context.dependencies)
+
+def execute(pattern, context, step):
+    return pattern.predicate(context, step, None)
+
+def analyze(model, transactions, traces, evaluate, indexed):
+    """ Runs the analysis of each transaction and returns the time spent evaluating patterns and the detections,
+    only evaluating the patterns indexed under the opcode of each step if indexed is set """
+    elapsed, detections = 0.0, 0
+    for transaction in transactions:
+        trace = {}
+        for step, instruction in enumerate(traces[transaction["hash"]]):
+            trace[step] = dict(instruction, transaction=transaction)
+        context = Context(trace, TaintRunner(), DynamicCallTree(), ControlFlowGraph(), {})
+        for step in range(len(trace)):
+            context.control_flow_graph.execute(trace, step, transaction)
+            context.taint_runner.propagate_taint(trace[step], context.control_flow_graph.current_contract_address)
+            context.call_tree.execute(trace, step)
+            begin = time.perf_counter()
+            context.memo.clear()
+            for pattern in model.pattern_index.get(trace[step]["op"], model.unanchored_patterns) if indexed else model.patterns:
+                try:
+                    if evaluate(pattern, context, step):
+                        detections += 1
+                except Exception as e:
+                    if not "error" in trace[step]:
+                        raise e
+            elapsed += time.perf_counter() - begin
+    return elapsed, detections
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the compiled and indexed patterns against the pattern interpreter on a recorded trace.")
+    parser.add_argument(
+        "trace", type=str, help="execution information saved with 'aegis.py --save'")
+    parser.add_argument(
+        "-p", "--patterns", type=str, default=os.path.join(AEGIS_FOLDER, settings.PATTERNS_FILE), help="file containing the patterns (default: the shipped '"+settings.PATTERNS_FILE+"')")
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=3, help="number of measurements, the fastest one is reported (default: 3)")
+    args = parser.parse_args()
+
+    model = load_model(args.patterns)
+    if not model or not "patterns" in dir(model):
+        print("No patterns found in "+args.patterns)
+        return
+
+    with open(args.trace) as file:
+        execution_trace = json.load(file)
+    traces = {transaction_hash: execution_trace["traces"][transaction_hash]["structLogs"] for transaction_hash in execution_trace["traces"]}
+    transactions = [transaction for transaction in execution_trace["transactions"] if transaction["hash"] in traces]
+    instructions = sum(len(traces[transaction["hash"]]) for transaction in transactions)
+    if not instructions:
+        print("No instructions found in "+args.trace)
+        return
+
+    interpreted = [analyze(model, transactions, traces, interpret, False) for _ in range(args.repeat)]
+    compiled = [analyze(model, transactions, traces, execute, True) for _ in range(args.repeat)]
+    if interpreted[0][1] != compiled[0][1]:
+        print("Warning: the interpreter detected %d pattern(s) and the compiled patterns %d." % (interpreted[0][1], compiled[0][1]))
+    interpreted, compiled = min(elapsed for elapsed, _ in interpreted), min(elapsed for elapsed, _ in compiled)
+
+    print("Patterns: \t\t %d" % len(model.patterns))
+    print("Instructions: \t\t %d" % instructions)
+    print("Interpreter: \t\t %.0f ns/instruction" % (interpreted / instructions * 1e9))
+    print("Compiled patterns: \t %.0f ns/instruction" % (compiled / instructions * 1e9))
+    print("Speedup: \t\t %.2fx" % (interpreted / compiled))
+
+if __name__ == '__main__':
+    main()
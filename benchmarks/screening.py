@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import http.client
+
+AEGIS_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis')
+sys.path.insert(0, AEGIS_FOLDER)
+
+import aegis
+import settings
+
+from trace_server import TraceServer
+
+def analyze(server, transactions, screen):
+    """ Returns the results of analyzing transactions whose traces are retrieved from the stand-in server,
+    the number of bytes it sent, the time taken and the output of the analysis """
+    settings.SCREEN_TRANSACTIONS = screen
+    server.sent = 0
+    connection = http.client.HTTPConnection(settings.RPC_HOST, settings.RPC_PORT)
+    output = io.StringIO()
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        results = aegis.analyze_transactions(connection, transactions)
+    elapsed = time.perf_counter() - begin
+    connection.close()
+    for result in results:
+        result.pop("execution_time", None)
+        # Skipped transactions are to have the results of analyzing them, which is no pattern
+        result.pop("screened", None)
+    return results, server.sent, elapsed, output.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares analyzing every transaction against screening transactions by their call structure first, from a stand-in server.")
+    parser.add_argument(
+        "trace", type=str, help="execution information saved with 'aegis.py --save'")
+    parser.add_argument(
+        "-p", "--patterns", type=str, default=os.path.join(AEGIS_FOLDER, settings.PATTERNS_FILE), help="file containing patterns to be analyzed (default: '"+settings.PATTERNS_FILE+"')")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds the stand-in server waits before answering each request (default: 0)")
+    args = parser.parse_args()
+
+    with open(args.trace) as file:
+        execution_trace = json.load(file)
+    server = TraceServer(("127.0.0.1", 0), execution_trace["traces"], args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Traces retrieved ahead of the analysis are retrieved over connections of their own
+    settings.RPC_HOST, settings.RPC_PORT = server.server_address[:2]
+
+    settings.PATTERNS_FILE = args.patterns
+    # Results are only collected when they are meant to be saved
+    settings.RESULTS_FOLDER = "results"
+    aegis.args = argparse.Namespace(load=None, save=None)
+
+    full, full_sent, full_elapsed, _ = analyze(server, execution_trace["transactions"], False)
+    screened, screened_sent, screened_elapsed, output = analyze(server, execution_trace["transactions"], True)
+    if full != screened:
+        print("Warning: the results of screened and unscreened analyses differ.")
+    skipped = output.count("Skipping transaction")
+    print("Transactions: \t\t %d (%d ruled out by their call structure)" % (len(execution_trace["transactions"]), skipped))
+    print("Without screening: \t %.1f MB in %.2f second(s)" % (full_sent / 1024 / 1024, full_elapsed))
+    print("With screening: \t %.1f MB in %.2f second(s)" % (screened_sent / 1024 / 1024, screened_elapsed))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+AEGIS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis', 'aegis.py')
+
+HEAVY_MODULES = ["web3", "requests", "textx", "eth_utils"]
+
+def run(arguments, home):
+    """ Returns the wall-clock time of an aegis.py invocation, whose patterns are cached under a home folder """
+    begin = time.perf_counter()
+    subprocess.run([sys.executable, AEGIS] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, env=dict(os.environ, HOME=home))
+    return time.perf_counter() - begin
+
+def run_python():
+    begin = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - begin
+
+def run_cold(arguments, home):
+    """ Returns the wall-clock time of an aegis.py invocation that parses the patterns """
+    shutil.rmtree(os.path.join(home, ".cache"), ignore_errors=True)
+    return run(arguments, home)
+
+def imported_modules(arguments, home):
+    """ Returns the heavy modules an aegis.py invocation imports """
+    process = subprocess.run([sys.executable, "-X", "importtime", AEGIS] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True, env=dict(os.environ, HOME=home))
+    modules = set()
+    for line in process.stderr.splitlines():
+        module = line.split("|")[-1].strip()
+        if module in HEAVY_MODULES:
+            modules.add(module)
+    return sorted(modules)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup time of aegis.py on a '--load' run.")
+    parser.add_argument(
+        "trace", type=str, nargs="?", help="execution information saved with 'aegis.py --save' (default: a single transaction stopping right away)")
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=10, help="number of invocations (default: 10)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        trace = args.trace
+        if not trace:
+            trace = os.path.join(folder, "stop.trace")
+            transaction = {"hash": "0x"+"00"*32, "blockNumber": 1, "from": "0x"+"00"*20, "to": "0x"+"00"*20, "input": "0x", "value": 0, "gas": 21000}
+            with open(trace, "w") as file:
+                json.dump({"transactions": [transaction], "traces": {transaction["hash"]: {"structLogs": [{"pc": 0, "op": "STOP", "gas": 21000, "gasCost": 0, "depth": 1, "stack": [], "memory": []}]}}}, file)
+        arguments = ["-t", "startup", "-l", trace]
+
+        # Warms up the file system and the patterns cache
+        run(arguments, folder)
+        times, cold_times = [], []
+        for _ in range(args.repeat):
+            times.append(run(arguments, folder))
+            cold_times.append(run_cold(arguments, folder))
+        times.sort()
+        cold_times.sort()
+        baseline = sorted(run_python() for _ in range(args.repeat))
+
+        print("Interpreter: \t\t %.0f ms" % (baseline[len(baseline) // 2] * 1000))
+        print("aegis.py --load: \t %.0f ms (median), %.0f ms (fastest)" % (times[len(times) // 2] * 1000, times[0] * 1000))
+        print("Without cached patterns: %.0f ms (median), %.0f ms (fastest)" % (cold_times[len(cold_times) // 2] * 1000, cold_times[0] * 1000))
+        print("Heavy imports: \t\t %s" % (", ".join(imported_modules(arguments, folder)) or "none"))
+
+if __name__ == '__main__':
+    main()
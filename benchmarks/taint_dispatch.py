@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis'))
+
+from dynamic_taint_analysis import TaintRunner
+
+def execute_trace_by_name(record, storage, instruction, opcode=None):
+    """ Applies an instruction by comparing opcode names, as done before the dispatch table """
+    assert len(record.stack) == len(instruction["stack"])
+
+    new_record = record.clone()
+    op = instruction["op"]
+
+    if op.startswith("PUSH"):
+        TaintRunner.mutate_push(new_record, storage, instruction)
+    elif op.startswith("DUP"):
+        TaintRunner.mutate_dup(new_record, storage, instruction, int(op[3:]))
+    elif op.startswith("SWAP"):
+        TaintRunner.mutate_swap(new_record, storage, instruction, int(op[4:]))
+    elif op == "MLOAD":
+        TaintRunner.mutate_mload(new_record, storage, instruction)
+    elif op.startswith("MSTORE"):
+        TaintRunner.mutate_mstore(new_record, storage, instruction)
+    elif op == "SLOAD":
+        TaintRunner.mutate_sload(new_record, storage, instruction)
+    elif op == "SSTORE":
+        TaintRunner.mutate_sstore(new_record, storage, instruction)
+    elif op.startswith("LOG"):
+        TaintRunner.mutate_log(new_record, storage, instruction, int(op[3:]))
+    elif op == "SHA3":
+        TaintRunner.mutate_sha3(new_record, storage, instruction)
+    elif op == "CALLVALUE":
+        TaintRunner.mutate_call_value(new_record, storage, instruction)
+    elif op == "CALLDATALOAD":
+        TaintRunner.mutate_call_data_load(new_record, storage, instruction)
+    elif op in ("CALLDATACOPY", "CODECOPY", "RETURNDATACOPY", "EXTCODECOPY"):
+        TaintRunner.mutate_copy(new_record, storage, instruction, TaintRunner.stack_taint_table[op][0])
+    elif op == "CREATE":
+        TaintRunner.mutate_create(new_record, storage, instruction)
+    elif op in ("CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"):
+        TaintRunner.mutate_call(new_record, storage, instruction, op in ("CALL", "CALLCODE"), TaintRunner.memory_access[op])
+    elif op == "RETURNDATASIZE":
+        TaintRunner.mutate_return_data_size(new_record, storage, instruction)
+    elif op in TaintRunner.stack_taint_table.keys():
+        TaintRunner.mutate_stack(new_record, storage, instruction, TaintRunner.stack_taint_table[op])
+
+    return new_record
+
+def propagate(traces, execute_trace):
+    original = TaintRunner.execute_trace
+    TaintRunner.execute_trace = staticmethod(execute_trace)
+    try:
+        begin = time.perf_counter()
+        for trace in traces:
+            taint_runner = TaintRunner()
+            # A dormant runner only tracks call frames, hence it is awakened to propagate taint from the first instruction
+            taint_runner.awaken()
+            for instruction in trace:
+                taint_runner.propagate_taint(instruction, None)
+        return time.perf_counter() - begin
+    finally:
+        TaintRunner.execute_trace = original
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the per-instruction cost of taint propagation on a recorded trace.")
+    parser.add_argument(
+        "trace", type=str, help="execution information saved with 'aegis.py --save'")
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=5, help="number of measurements, the fastest one is reported (default: 5)")
+    args = parser.parse_args()
+
+    with open(args.trace) as file:
+        execution_trace = json.load(file)
+    traces = [execution_trace["traces"][transaction["hash"]]["structLogs"] for transaction in execution_trace["transactions"] if transaction["hash"] in execution_trace["traces"]]
+    instructions = sum(len(trace) for trace in traces)
+    if not instructions:
+        print("No instructions found in "+args.trace)
+        return
+
+    # Measurements alternate, so that both are taken under the same load
+    by_name, by_opcode = [], []
+    for _ in range(args.repeat):
+        by_name.append(propagate(traces, execute_trace_by_name))
+        by_opcode.append(propagate(traces, TaintRunner.execute_trace))
+    by_name, by_opcode = min(by_name), min(by_opcode)
+
+    print("Instructions: \t\t %d" % instructions)
+    print("Name comparisons: \t %.0f ns/instruction" % (by_name / instructions * 1e9))
+    print("Dispatch table: \t %.0f ns/instruction" % (by_opcode / instructions * 1e9))
+    print("Speedup: \t\t %.2fx" % (by_name / by_opcode))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import http.client
+
+AEGIS_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis')
+sys.path.insert(0, AEGIS_FOLDER)
+
+import aegis
+import settings
+
+from trace_server import TraceServer
+
+def analyze(server, transactions):
+    """ Returns the results of analyzing transactions whose traces are retrieved from the stand-in server
+    or the trace cache, the number of bytes the server sent and the time taken """
+    server.sent = 0
+    connection = http.client.HTTPConnection(settings.RPC_HOST, settings.RPC_PORT)
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = aegis.analyze_transactions(connection, transactions)
+    elapsed = time.perf_counter() - begin
+    connection.close()
+    for result in results:
+        result.pop("execution_time", None)
+    return results, server.sent, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares analyzing transactions with an empty trace cache against analyzing them again with a warm one, from a stand-in server.")
+    parser.add_argument(
+        "trace", type=str, help="execution information saved with 'aegis.py --save'")
+    parser.add_argument(
+        "-p", "--patterns", type=str, default=os.path.join(AEGIS_FOLDER, settings.PATTERNS_FILE), help="file containing patterns to be analyzed (default: '"+settings.PATTERNS_FILE+"')")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds the stand-in server waits before answering each request (default: 0)")
+    args = parser.parse_args()
+
+    with open(args.trace) as file:
+        execution_trace = json.load(file)
+    server = TraceServer(("127.0.0.1", 0), execution_trace["traces"], args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Traces retrieved ahead of the analysis are retrieved over connections of their own
+    settings.RPC_HOST, settings.RPC_PORT = server.server_address[:2]
+
+    settings.PATTERNS_FILE = args.patterns
+    # Results are only collected when they are meant to be saved
+    settings.RESULTS_FOLDER = "results"
+    settings.TRACE_CACHE = tempfile.mkdtemp()
+    aegis.args = argparse.Namespace(load=None, save=None)
+
+    try:
+        cold, cold_sent, cold_elapsed = analyze(server, execution_trace["transactions"])
+        warm, warm_sent, warm_elapsed = analyze(server, execution_trace["transactions"])
+        cached = sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(settings.TRACE_CACHE) for name in names)
+    finally:
+        shutil.rmtree(settings.TRACE_CACHE)
+    if cold != warm:
+        print("Warning: the results of the analyses with an empty and a warm trace cache differ.")
+    print("Cached traces: \t\t %.1f MB (%.1f MB of JSON)" % (cached / 1024 / 1024, len(json.dumps(execution_trace["traces"])) / 1024 / 1024))
+    print("Empty trace cache: \t %.1f MB retrieved in %.2f second(s)" % (cold_sent / 1024 / 1024, cold_elapsed))
+    print("Warm trace cache: \t %.1f MB retrieved in %.2f second(s)" % (warm_sent / 1024 / 1024, warm_elapsed))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aegis'))
+
+from utils import call_structure
+
+MEMORY_OPCODES = re.compile(r'memoryOpcodes\s*:\s*(\{[^}]*\})')
+
+def shape_trace(trace, tracer):
+    """ Returns a recorded trace as the structLog tracer of aegis.py emits it, which is recognized by the opcodes
+    it emits memory on, since the stand-in server cannot run JavaScript """
+    match = MEMORY_OPCODES.search(tracer)
+    if not match:
+        raise ValueError("Unsupported tracer")
+    memory_opcodes = json.loads(match.group(1))
+    struct_logs = []
+    for struct_log in trace["structLogs"]:
+        shaped = {key: struct_log[key] for key in ["pc", "op", "gas", "gasCost", "depth"]}
+        shaped["stack"] = ["%064x" % int(word, 16) for word in struct_log.get("stack", [])]
+        if struct_log["op"] in memory_opcodes:
+            shaped["memory"] = struct_log.get("memory", [])
+        if "error" in struct_log:
+            shaped["error"] = str(struct_log["error"])
+        struct_logs.append(shaped)
+    return {"gas": trace.get("gas", 0), "failed": trace.get("failed", False), "returnValue": trace.get("returnValue", ""), "structLogs": struct_logs}
+
+class TraceServer(ThreadingHTTPServer):
+    def __init__(self, address, traces, latency=0.0):
+        """ Stand-in JSON-RPC server answering debug_traceTransaction with recorded traces, honoring disableStack,
+        disableMemory and the tracers of aegis.py. The number of bytes sent is counted in sent """
+        super().__init__(address, TraceRequestHandler)
+        self.traces = traces
+        self.latency = latency
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def respond(self, request):
+        if request.get("method") != "debug_traceTransaction":
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32601, "message": "the method "+str(request.get("method"))+" does not exist/is not available"}}
+        transaction_hash, options = request["params"][0], request["params"][1] if len(request["params"]) > 1 else {}
+        if not transaction_hash in self.traces:
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32000, "message": "transaction "+transaction_hash+" not found"}}
+        trace = self.traces[transaction_hash]
+        if options.get("tracer") and "frames" in options["tracer"]:
+            trace = call_structure(trace["structLogs"])
+        elif options.get("tracer"):
+            try:
+                trace = shape_trace(trace, options["tracer"])
+            except ValueError as e:
+                return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32000, "message": str(e)}}
+        elif options.get("disableStack") or options.get("disableMemory"):
+            disabled = [key for key, option in [("stack", "disableStack"), ("memory", "disableMemory")] if options.get(option)]
+            trace = dict(trace, structLogs=[{key: struct_log[key] for key in struct_log if not key in disabled} for struct_log in trace["structLogs"]])
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": trace}
+
+class TraceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency)
+        response = json.dumps(self.server.respond(request)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        with self.server.lock:
+            self.server.sent += len(response)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the traces of execution information saved with 'aegis.py --save' over debug_traceTransaction.")
+    parser.add_argument(
+        "trace", type=str, help="execution information saved with 'aegis.py --save'")
+    parser.add_argument(
+        "--host", type=str, default="localhost", help="listening interface (default: 'localhost')")
+    parser.add_argument(
+        "--port", type=int, default=8545, help="listening port (default: 8545)")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds waited before answering each request (default: 0)")
+    args = parser.parse_args()
+
+    with open(args.trace) as file:
+        traces = json.load(file)["traces"]
+    server = TraceServer((args.host, args.port), traces, args.latency)
+    print("Serving "+str(len(traces))+" trace(s) on http://"+args.host+":"+str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()